@@ -164,8 +164,8 @@ class ProgressReporter:
         self.timestamp = get_time()
         self.interval = interval
 
-    def update(self):
-        self.count += 1
+    def update(self, n=1):
+        self.count += n
         if settings.verbosity > 1 and (get_time() - self.timestamp > self.interval or self.count == self.total):
             self.timestamp = get_time()
             percent = int(self.count * 100 / self.total)
@@ -5,7 +5,7 @@ from matplotlib.colors import ColorConverter
 from pandas import unique
 from scipy.sparse import issparse
 from .utils import is_categorical, interpret_colorkey, default_basis, default_size, get_components, savefig_or_show, \
-    default_color, make_unique_list, set_colorbar, default_color_map, set_label, set_title
+    default_color, make_unique_list, set_colorbar, default_color_map, set_label, set_title, get_layer, has_layer
 
 
 def heatmap(adata, var_names, groups=None, groupby=None, annotations=None, use_raw=False, layers=['X'], color_map=None,
@@ -85,7 +85,7 @@ def heatmap(adata, var_names, groups=None, groupby=None, annotations=None, use_r
         layers = ['X']
     if isinstance(layers, str):
         layers = [layers]
-    layers = [layer for layer in layers if layer in adata.layers.keys() or layer == 'X']
+    layers = [layer for layer in layers if has_layer(adata, layer) or layer == 'X']
     if len(layers) == 0:
         raise ValueError(
             'The selected layers are not contained'
@@ -96,11 +96,11 @@ def heatmap(adata, var_names, groups=None, groupby=None, annotations=None, use_r
         if 'spliced' in layers: layers[np.array([layer == 'spliced' for layer in layers])] = 'Ms'
         if 'unspliced' in layers: layers[np.array([layer == 'unspliced' for layer in layers])] = 'Ms'
         layers = list(layers)
-    if 'Ms' in layers and 'Ms' not in adata.layers.keys():
+    if 'Ms' in layers and not has_layer(adata, 'Ms'):
         raise ValueError(
             'Moments have to be computed before'
             'using this plot function.')
-    if 'Mu' in layers and 'Mu' not in adata.layers.keys():
+    if 'Mu' in layers and not has_layer(adata, 'Mu'):
         raise ValueError(
             'Moments have to be computed before'
             'using this plot function.')
@@ -151,7 +151,7 @@ def heatmap(adata, var_names, groups=None, groupby=None, annotations=None, use_r
                     if layer == 'X':
                         laydat = dat.X
                     else:
-                        laydat = dat.layers[layer]
+                        laydat = get_layer(dat, layer)
 
                     t1, t2, t3 = idx_group, idx_var, idx_pt
                     t1 = t1[t3]
@@ -254,7 +254,7 @@ def heatmap(adata, var_names, groups=None, groupby=None, annotations=None, use_r
                 if layer == 'X':
                     laydat = dat.X
                 else:
-                    laydat = dat.layers[layer]
+                    laydat = get_layer(dat, layer)
                 laydat = laydat[idx]
                 if issparse(laydat):
                     laydat = laydat.A
@@ -1,8 +1,8 @@
 from .. import settings
 from .. import AnnData
-from .utils import make_dense, is_categorical, update_axes, set_label, set_title, interpret_colorkey, set_colorbar, \
+from .utils import is_categorical, update_axes, set_label, set_title, interpret_colorkey, set_colorbar, \
     default_basis, default_color, default_size, default_color_map, get_components, savefig_or_show, make_unique_list, \
-    show_linear_fit
+    show_linear_fit, get_layer, has_layer
 from .docs import doc_scatter, doc_params
 
 from matplotlib import rcParams
@@ -83,9 +83,8 @@ def scatter(adata=None, x=None, y=None, basis=None, vkey=None, color=None, use_r
 
         else:
             if basis in adata.var_names:
-                xkey, ykey = ('spliced', 'unspliced') if use_raw or 'Ms' not in adata.layers.keys() else ('Ms', 'Mu')
-                x = make_dense(adata[:, basis].layers[xkey])
-                y = make_dense(adata[:, basis].layers[ykey])
+                xkey, ykey = ('spliced', 'unspliced') if use_raw or not has_layer(adata, 'Ms') else ('Ms', 'Mu')
+                x, y = get_layer(adata, xkey, basis), get_layer(adata, ykey, basis)
                 xlabel, ylabel = 'spliced', 'unspliced'
                 title = basis if title is None else title
 
@@ -94,8 +93,8 @@ def scatter(adata=None, x=None, y=None, basis=None, vkey=None, color=None, use_r
                 x, y = X_emb[:, 0], X_emb[:, 1]
 
             elif isinstance(x, str) and isinstance(y, str) and x in adata.var_names and y in adata.var_names:
-                x = adata[:, x].layers[layer] if layer in adata.layers.keys() else adata[:, x].X
-                y = adata[:, y].layers[layer] if layer in adata.layers.keys() else adata[:, y].X
+                x = get_layer(adata, layer, x) if has_layer(adata, layer) else adata[:, x].X
+                y = get_layer(adata, layer, y) if has_layer(adata, layer) else adata[:, y].X
 
             if basis in adata.var_names and isinstance(color, str) and color in adata.layers.keys():
                 c = interpret_colorkey(adata, basis, color, perc)
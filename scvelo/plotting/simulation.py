@@ -1,5 +1,5 @@
 from ..tools.dynamical_model_utils import unspliced, spliced, vectorize, tau_u
-from .utils import make_dense
+from .utils import make_dense, get_layer, has_layer
 
 import numpy as np
 import matplotlib.pyplot as pl
@@ -41,8 +41,8 @@ def show_full_dynamics(adata, basis, key='true', use_raw=False, linewidth=1):
         _, ut, st, _ = compute_dynamics(adata, basis, key, extrapolate=False, sort=False)
         pl.scatter(st, ut, color=color, s=1)
         if len(st) < 500:
-            skey, ukey = ('spliced', 'unspliced') if use_raw or 'Ms' not in adata.layers.keys() else ('Ms', 'Mu')
-            s, u = make_dense(adata[:, basis].layers[skey]), make_dense(adata[:, basis].layers[ukey])
+            skey, ukey = ('spliced', 'unspliced') if use_raw or not has_layer(adata, 'Ms') else ('Ms', 'Mu')
+            s, u = make_dense(get_layer(adata, skey, basis)), make_dense(get_layer(adata, ukey, basis))
             pl.plot(np.array([s, st]), np.array([u, ut]), color='grey', linewidth=.2 * linewidth)
 
     idx = np.where(adata.var_names == basis)[0][0]
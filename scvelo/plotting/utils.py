@@ -1,5 +1,6 @@
 from .. import settings
 from .. import logging as logg
+from ..preprocessing.moments import get_moments
 from . import palettes
 
 import os
@@ -17,6 +18,19 @@ def make_dense(X):
     return X.A if issparse(X) and X.ndim == 2 else X.A1 if issparse(X) else X
 
 
+def has_layer(adata, layer):
+    return layer in adata.layers.keys() or (layer in {'Ms', 'Mu'} and 'moments' in adata.uns.keys())
+
+
+def get_layer(adata, layer, var_names=None):
+    """layer (of the genes var_names), with moments read through `get_moments` to support `pp.moments(lazy=True)`.
+    A single gene name yields a 1d array.
+    """
+    if layer in {'Ms', 'Mu'} and layer not in adata.layers.keys(): X = get_moments(adata, layer, var_names)
+    else: X = adata.layers[layer] if var_names is None else adata[:, var_names].layers[layer]
+    return make_dense(X).flatten() if isinstance(var_names, str) else make_dense(X)
+
+
 def strings_to_categoricals(adata):
     """Transform string annotations to categoricals.
     """
@@ -138,7 +152,7 @@ def interpret_colorkey(adata, c=None, layer=None, perc=None):
         if c in adata.obs.keys():  # color by observation key
             c = adata.obs[c]
         elif c in adata.var_names:  # color by var in specific layer
-            c = adata[:, c].layers[layer] if layer in adata.layers.keys() else adata[:, c].X
+            c = get_layer(adata, layer, c) if has_layer(adata, layer) else adata[:, c].X
             c = c.A.flatten() if issparse(c) else c
         else:
             raise ValueError('color key is invalid! pass valid observation annotation or a gene name')
@@ -245,7 +259,7 @@ def adjust_palette(palette, length):
 
 
 def show_linear_fit(adata, basis, vkey, xkey, linewidth=1):
-    xnew = np.linspace(0, np.percentile(make_dense(adata[:, basis].layers[xkey]), 98))
+    xnew = np.linspace(0, np.percentile(get_layer(adata, xkey, basis), 98))
     vkeys = adata.layers.keys() if vkey is None else make_unique_list(vkey)
     fits = [fit for fit in vkeys if all(['velocity' in fit, fit + '_gamma' in adata.var.keys()])]
     for fit in fits:
@@ -1,14 +1,13 @@
 from ..preprocessing.moments import second_order_moments
 from ..tools.rank_velocity_genes import rank_velocity_genes
 from .scatter import scatter
-from .utils import savefig_or_show, default_basis, default_size
+from .utils import savefig_or_show, default_basis, default_size, get_layer, has_layer
 
 import numpy as np
 import pandas as pd
 from matplotlib import rcParams
 from matplotlib.ticker import MaxNLocator
 import matplotlib.pyplot as pl
-from scipy.sparse import issparse
 
 
 def velocity(adata, var_names=None, basis=None, groupby=None, groups=None, mode=None, fits='all', layers='all',
@@ -78,7 +77,7 @@ def velocity(adata, var_names=None, basis=None, groupby=None, groups=None, mode=
 
     (skey, ukey) = ('spliced', 'unspliced') if use_raw else ('Ms', 'Mu')
     layers = ['velocity', skey, 'variance_velocity'] if layers == 'all' else layers
-    layers = [layer for layer in layers if layer in adata.layers.keys()]
+    layers = [layer for layer in layers if has_layer(adata, layer)]
 
     fits = adata.layers.keys() if fits == 'all' else fits
     fits = [fit for fit in fits if all(['velocity' in fit, fit + '_gamma' in adata.var.keys()])]
@@ -96,8 +95,7 @@ def velocity(adata, var_names=None, basis=None, groupby=None, groups=None, mode=
     fontsize = rcParams['font.size'] if fontsize is None else fontsize
     for v, var in enumerate(var_names):
         _adata = adata[:, var]
-        s, u = _adata.layers[skey], _adata.layers[ukey]
-        if issparse(s): s, u = s.A, u.A
+        s, u = get_layer(adata, skey, var), get_layer(adata, ukey, var)
 
         # spliced/unspliced phase portrait with steady-state estimate
         ax = pl.subplot(gs[v * nplts])
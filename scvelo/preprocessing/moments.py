@@ -1,14 +1,19 @@
 from .. import settings
 from .. import logging as logg
 from .utils import not_yet_normalized, normalize_per_cell
-from .neighbors import neighbors, get_connectivities, neighbors_to_be_recomputed
-
-from scipy.sparse import csr_matrix
+from .neighbors import neighbors, get_connectivities, neighbors_to_be_recomputed, get_graph_version, \
+    get_obs_key
+
+from scipy.sparse import csr_matrix, hstack
+from collections import OrderedDict
+from threading import Lock
+from weakref import WeakValueDictionary
+from uuid import uuid4
 import numpy as np
 
 
 def moments(data, n_neighbors=30, n_pcs=30, mode='connectivities', method='umap', metric='euclidean', use_rep=None,
-            recurse_neighbors=False, renormalize=False, copy=False):
+            recurse_neighbors=False, renormalize=False, second_order=False, lazy=False, copy=False):
     """Computes moments for velocity estimation.
 
     Arguments
@@ -23,6 +28,13 @@ def moments(data, n_neighbors=30, n_pcs=30, mode='connectivities', method='umap'
         Distance metric to use for moment computation.
     renormalize: `bool` (default: `False`)
         Renormalize the moments by total counts per cell to its median.
+    second_order: `bool` (default: `False`)
+        Whether to also compute the second order moments in the same pass and store them as layers `Mss` and `Mus`,
+        which are then used by stochastic velocity estimation and plotting instead of being recomputed, as long as the
+        neighbor graph is not recomputed or updated.
+    lazy: `bool` (default: `False`)
+        Whether to only store the normalized connectivities in `adata.uns['moments']` instead of dense `Ms`/`Mu`
+        layers. Moments are then computed on demand for the genes requested downstream (see `get_moments`).
     copy: `bool` (default: `False`)
         Return a copy instead of writing to adata.
 
@@ -50,40 +62,153 @@ def moments(data, n_neighbors=30, n_pcs=30, mode='connectivities', method='umap'
 
     connectivities = get_connectivities(adata, mode, n_neighbors=n_neighbors, recurse_neighbors=recurse_neighbors)
 
-    adata.layers['Ms'] = csr_matrix.dot(connectivities, csr_matrix(adata.layers['spliced'])).astype(np.float32).A
-    adata.layers['Mu'] = csr_matrix.dot(connectivities, csr_matrix(adata.layers['unspliced'])).astype(np.float32).A
+    if lazy:
+        if renormalize: raise ValueError('renormalize is not supported for lazy moments.')
+        for key in ['Ms', 'Mu', 'Mss', 'Mus']:
+            if key in adata.layers.keys(): del adata.layers[key]
+        adata.uns['moments'] = {'connectivities': connectivities, 'key': uuid4().hex, 'obs_key': get_obs_key(adata)}
+        _lazy_moments_data[adata.uns['moments']['key']] = adata
+
+        logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
+        logg.hint(
+            'added \n'
+            '    \'moments\', connectivities to compute moments on demand (adata.uns)')
+        return adata if copy else None
+    if 'moments' in adata.uns.keys(): del adata.uns['moments']
+
+    s, u = csr_matrix(adata.layers['spliced']), csr_matrix(adata.layers['unspliced'])
+    moments_ = fused_moments(connectivities, s, u, second_order=second_order)
+    adata.layers['Ms'], adata.layers['Mu'] = moments_[:2]
     if renormalize: normalize_per_cell(adata, layers={'Ms', 'Mu'}, enforce=True)
+    if second_order:
+        adata.layers['Mss'], adata.layers['Mus'] = moments_[2:]
+        # ties the layers to the graph version they were computed from, such that they are ignored once it changes
+        adata.uns['neighbors']['second_order_moments'] = {'mode': mode, 'version': get_graph_version(adata)}
+    else:  # remove second order moments of previous runs, which may be out of date
+        for key in ['Mss', 'Mus']:
+            if key in adata.layers.keys(): del adata.layers[key]
 
     logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
     logg.hint(
         'added \n'
-        '    \'Ms\' and \'Mu\', moments of spliced/unspliced abundances (adata.layers)')
+        '    \'Ms\' and \'Mu\', moments of spliced/unspliced abundances (adata.layers)'
+        + ('\n    \'Mss\' and \'Mus\', second order moments (adata.layers)' if second_order else ''))
     return adata if copy else None
 
 
-def second_order_moments(adata, adjusted=False):
+def fused_moments(connectivities, s, u, second_order=True):
+    """Computes Ms, Mu (and Mss, Mus) in one traversal of the connectivities, as product with [s, u, s * s, s * u].
+    """
+    n_vars = s.shape[1]
+    X = [s, u, s.multiply(s), s.multiply(u)] if second_order else [s, u]
+    M = csr_matrix.dot(connectivities, hstack(X, format='csr')).astype(np.float32)
+    return [M[:, i * n_vars:(i + 1) * n_vars].A for i in range(len(X))]
+
+
+_moments_cache, _moments_cache_lock = OrderedDict(), Lock()
+_lazy_moments_data = WeakValueDictionary()  # adata of each lazy moments key, from which views take their counts
+
+
+def get_moments(adata, layer='Ms', var_idx=None, max_cache_size=None):
+    """Moments `Ms` or `Mu` for the genes var_idx (mask, indices or names), taken from `adata.layers` or, with
+    `pp.moments(lazy=True)`, computed on demand for the requested genes only.
+
+    Lazily computed gene columns are kept in a least recently used cache of at most max_cache_size GB
+    (default: `settings.max_memory / 10`), keyed by the lazy moments and the cells they were computed for. Lazy
+    moments of cells that were subset or reordered since `pp.moments(lazy=True)` (other than by a view) are refused.
+    A view takes the counts of the adata the lazy moments were computed for (or last requested from), and its cells
+    by obs_names.
+    """
+    if isinstance(var_idx, str) or (var_idx is not None and len(var_idx) > 0 and isinstance(var_idx[0], str)):
+        var_idx = adata.var_names.get_indexer([var_idx] if isinstance(var_idx, str) else var_idx)
+    if layer in adata.layers.keys():
+        return adata.layers[layer] if var_idx is None else adata.layers[layer][:, var_idx]
+
+    if 'moments' not in adata.uns.keys() or layer not in {'Ms', 'Mu'}:
+        raise ValueError('You need to run `pp.moments` first to compute ' + layer + '.')
+    adata_ref = _lazy_moments_data.get(adata.uns['moments']['key']) if adata.is_view else adata
+    if adata_ref is None:
+        raise ValueError('The data of lazy moments of a view is not in memory. You need to pass the full adata.')
+    connectivities, key = adata_ref.uns['moments']['connectivities'], adata_ref.uns['moments']['key']
+    obs_key = get_obs_key(adata_ref)
+    if obs_key != adata_ref.uns['moments'].get('obs_key') or connectivities.shape[0] != adata_ref.n_obs:
+        raise ValueError('Cells changed since `pp.moments(lazy=True)`. You need to rerun `pp.moments`.')
+    obs_idx = adata_ref.obs_names.get_indexer(adata.obs_names) if adata.is_view else slice(None)
+    if adata.is_view and np.any(obs_idx < 0):
+        raise ValueError('Cells changed since `pp.moments(lazy=True)`. You need to rerun `pp.moments`.')
+    if not adata.is_view: _lazy_moments_data[key] = adata  # e.g. read from file
+    key = (key, obs_key)
+    var_names = adata.var_names if var_idx is None else adata.var_names[var_idx]
+
+    max_cache_size = settings.max_memory / 10 if max_cache_size is None else max_cache_size
+    with _moments_cache_lock:
+        missing = [name for name in var_names if (key, layer, name) not in _moments_cache]
+        if len(missing) > 0:
+            X = csr_matrix(adata_ref.layers['spliced' if layer == 'Ms' else 'unspliced'])
+            M = csr_matrix.dot(connectivities, X[:, adata_ref.var_names.get_indexer(missing)]).astype(np.float32).A
+            for name, column in zip(missing, M.T):
+                _moments_cache[(key, layer, name)] = np.array(column)
+
+        for name in var_names: _moments_cache.move_to_end((key, layer, name))
+        M = np.stack([_moments_cache[(key, layer, name)] for name in var_names], 1)
+        cache_size = sum(column.nbytes for column in _moments_cache.values())
+        while cache_size > max_cache_size * 1e9 and len(_moments_cache) > 0:
+            cache_size -= _moments_cache.popitem(last=False)[1].nbytes
+    return M[obs_idx]
+
+
+def has_second_order_moments(adata):
+    """whether adata has layers Mss and Mus computed by `pp.moments(second_order=True)` from the current version of
+    its neighbor graph
+    """
+    if 'Mss' not in adata.layers.keys() or 'Mus' not in adata.layers.keys() or 'neighbors' not in adata.uns.keys():
+        return False
+    cache = adata.uns['neighbors'].get('second_order_moments', {})
+    return 'version' in cache and cache['version'] == get_graph_version(adata)
+
+
+def second_order_moments(adata, adjusted=False, obs_idx=None, var_idx=None):
     """Computes second order moments for stochastic velocity estimation.
 
     Arguments
     ---------
     adata: `AnnData`
         Annotated data matrix.
+    obs_idx: `np.ndarray` or `None` (default: `None`)
+        Restrict to these cells (rows), which are computed from their neighbors only.
+    var_idx: `np.ndarray` or `None` (default: `None`)
+        Restrict to these genes (columns).
 
     Returns
     -------
     Mss: Second order moments for spliced abundances
     Mus: Second order moments for spliced with unspliced abundances
     """
-    if 'neighbors' not in adata.uns:
-        raise ValueError('You need to run `pp.neighbors` first to compute a neighborhood graph.')
-
-    connectivities = get_connectivities(adata)
-    s, u = csr_matrix(adata.layers['spliced']), csr_matrix(adata.layers['unspliced'])
-    Mss = csr_matrix.dot(connectivities, s.multiply(s)).astype(np.float32).A
-    Mus = csr_matrix.dot(connectivities, s.multiply(u)).astype(np.float32).A
+    if has_second_order_moments(adata):  # cached by pp.moments(second_order=True)
+        Mss, Mus = adata.layers['Mss'], adata.layers['Mus']
+        if obs_idx is not None: Mss, Mus = Mss[obs_idx], Mus[obs_idx]
+        if var_idx is not None: Mss, Mus = Mss[:, var_idx], Mus[:, var_idx]
+        Mss, Mus = np.array(Mss, dtype=np.float32), np.array(Mus, dtype=np.float32)
+
+    else:
+        if 'neighbors' not in adata.uns:
+            raise ValueError('You need to run `pp.neighbors` first to compute a neighborhood graph.')
+
+        connectivities = get_connectivities(adata)
+        s, u = csr_matrix(adata.layers['spliced']), csr_matrix(adata.layers['unspliced'])
+        if obs_idx is not None:
+            connectivities = connectivities[obs_idx]
+            neighs_idx = np.unique(connectivities.indices)
+            connectivities, s, u = connectivities[:, neighs_idx], s[neighs_idx], u[neighs_idx]
+        if var_idx is not None:
+            s, u = s[:, var_idx], u[:, var_idx]
+        Mss = csr_matrix.dot(connectivities, s.multiply(s)).astype(np.float32).A
+        Mus = csr_matrix.dot(connectivities, s.multiply(u)).astype(np.float32).A
     if adjusted:
-        Mss = 2 * Mss - adata.layers['Ms'].reshape(Mss.shape)
-        Mus = 2 * Mus - adata.layers['Mu'].reshape(Mus.shape)
+        Ms, Mu = get_moments(adata, 'Ms', var_idx), get_moments(adata, 'Mu', var_idx)
+        if obs_idx is not None: Ms, Mu = Ms[obs_idx], Mu[obs_idx]
+        Mss = 2 * Mss - Ms.reshape(Mss.shape)
+        Mus = 2 * Mus - Mu.reshape(Mus.shape)
     return Mss, Mus
 
 
@@ -3,12 +3,15 @@ from .. import logging as logg
 
 from scanpy.api import Neighbors
 from scanpy.api.pp import pca
-from scipy.sparse import issparse
+from scipy.sparse import csr_matrix, issparse
+from collections import OrderedDict
 import numpy as np
+import weakref
+import os
 
 
 def neighbors(adata, n_neighbors=30, n_pcs=30, use_rep=None, knn=True, random_state=0, method='umap',
-              metric='euclidean', metric_kwds={}, copy=False):
+              metric='euclidean', metric_kwds={}, incremental=False, copy=False):
     """
     Compute a neighborhood graph of observations [McInnes18]_.
     The neighbor search efficiency of this heavily relies on UMAP [McInnes18]_,
@@ -44,10 +47,23 @@ def neighbors(adata, n_neighbors=30, n_pcs=30, use_rep=None, knn=True, random_st
     method : {{'umap', 'gauss', `sklearn`, `None`}}  (default: `'umap'`)
         Use 'umap' [McInnes18]_ or 'gauss' (Gauss kernel following [Coifman05]_
         with adaptive width [Haghverdi16]_) for computing connectivities.
+        'sklearn' computes exact neighbors with binary connectivities, querying
+        blocks of cells in parallel (`settings.n_jobs`).
     metric
         A known metric’s name or a callable that returns a distance.
     metric_kwds
         Options for the metric.
+    incremental : `bool` (default: `False`)
+        Whether to update an existing neighborhood graph for newly appended cells instead of recomputing it.
+        New cells (the rows of adata beyond those of `.uns['neighbors']`) are projected onto the existing
+        `.varm['PCs']` and queried against a kNN index persisted in `settings.cachedir`. Their rows are appended,
+        while existing cells are only queried against the new cells to adopt them as neighbors where closer.
+        The cells of the existing graph need to come first and in the same order, which is verified by obs_names.
+        Cells whose neighbors changed are stored in `.uns['neighbors']['updated_cells']`, which can be passed to
+        `tl.velocity_graph(update_cells=...)`. If there is no graph yet, it is computed and its index persisted.
+        Only for exact neighbors (`method='sklearn'`), the graph is the same as if computed on all cells in the
+        same representation (new cells being projected onto the existing PCs). With `method='umap'`, it approximates
+        that graph, as the updated neighbors are searched exactly instead of by nearest neighbor descent.
     copy
         Return a copy instead of writing to adata.
     Returns
@@ -64,19 +80,31 @@ def neighbors(adata, n_neighbors=30, n_pcs=30, use_rep=None, knn=True, random_st
     adata = adata.copy() if copy else adata
     if adata.isview: adata._init_as_actual(adata.copy())
 
+    n_obs_graph = adata.uns['neighbors']['distances'].shape[0] if 'neighbors' in adata.uns.keys() else 0
+    if incremental and 0 < n_obs_graph < adata.n_obs:
+        update_neighbors(adata, n_pcs=n_pcs, use_rep=use_rep, metric=metric, metric_kwds=metric_kwds)
+        logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
+        logg.hint(
+            'updated `.uns[\'neighbors\']` with ' + str(adata.n_obs - n_obs_graph) + ' new cells\n'
+            '    \'updated_cells\', cells whose neighbors changed')
+        return adata if copy else None
+
     if (use_rep is None or use_rep is 'X_pca') \
             and ('X_pca' not in adata.obsm.keys() or n_pcs > adata.obsm['X_pca'].shape[1]):
         pca(adata, n_comps=n_pcs, svd_solver='arpack')
 
+    version = get_graph_version(adata) + 1 if 'neighbors' in adata.uns.keys() else 1
     adata.uns['neighbors'] = {}
-    adata.uns['neighbors']['params'] = {'n_neighbors': n_neighbors, 'method': method}
+    adata.uns['neighbors']['params'] = {'n_neighbors': n_neighbors, 'method': method, 'obs_key': get_obs_key(adata),
+                                        'version': version}
 
     if method is 'sklearn':
-        from sklearn.neighbors import NearestNeighbors
-        neighbors = NearestNeighbors(n_neighbors=n_neighbors)
-        neighbors.fit(adata.obsm['X_pca'] if use_rep is None else adata.obsm[use_rep])
-        adata.uns['neighbors']['distances'] = neighbors.kneighbors_graph(mode='distance')
-        adata.uns['neighbors']['connectivities'] = neighbors.kneighbors_graph(mode='connectivity')
+        X = adata.obsm['X_pca'] if use_rep is None else adata.obsm[use_rep]
+        indices, dists = compute_neighbors_exact(X, n_neighbors, metric=metric, metric_kwds=metric_kwds)
+        distances, connectivities = get_neighbors_graphs(indices, dists)
+        adata.uns['neighbors']['distances'] = distances
+        adata.uns['neighbors']['connectivities'] = connectivities
+        adata.uns['neighbors']['indices'] = indices
 
     else:
         neighbors = Neighbors(adata)
@@ -84,7 +112,14 @@ def neighbors(adata, n_neighbors=30, n_pcs=30, use_rep=None, knn=True, random_st
                                     metric=metric, metric_kwds=metric_kwds, random_state=random_state, write_knn_indices=True)
         adata.uns['neighbors']['distances'] = neighbors.distances
         adata.uns['neighbors']['connectivities'] = neighbors.connectivities
-        adata.uns['neighbors']['indices'] = neighbors.knn_indices
+        adata.uns['neighbors']['indices'] = neighbors.knn_indices.astype(np.int32)
+
+    if incremental:
+        adata.uns['neighbors']['params'].update({'n_pcs': n_pcs, 'metric': metric})
+        if use_rep is not None: adata.uns['neighbors']['params']['use_rep'] = use_rep
+        X = get_neighbors_rep(adata, n_pcs, use_rep, method)
+        mean = np.asarray(adata.X.mean(0), dtype=np.float32).ravel() if use_rep in {None, 'X_pca'} else None
+        write_neighbors_index(adata, {'mean': mean, 'segments': [(0, fit_neighbors_index(X, metric, metric_kwds))]})
 
     logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
     logg.hint(
@@ -94,36 +129,239 @@ def neighbors(adata, n_neighbors=30, n_pcs=30, use_rep=None, knn=True, random_st
     return adata if copy else None
 
 
-def select_distances(dist, n_neighbors=None):
-    D = dist.copy()
-    n_counts = (D > 0).sum(1).A1 if issparse(D) else (D > 0).sum(1)
-    n_neighbors = n_counts.min() if n_neighbors is None else min(n_counts.min(), n_neighbors)
-    rows = np.where(n_counts > n_neighbors)[0]
-    cumsum_neighs = np.insert(n_counts.cumsum(), 0, 0)
-    dat = D.data
-
-    for row in rows:
-        n0, n1 = cumsum_neighs[row], cumsum_neighs[row + 1]
-        rm_idx = n0 + dat[n0:n1].argsort()[n_neighbors:]
-        dat[rm_idx] = 0
+def get_obs_key(adata, n_obs=None):
+    """md5 fingerprint of the cells (obs_names) of adata, or of its first n_obs cells
+    """
+    from hashlib import md5
+    return md5('\n'.join(adata.obs_names[:n_obs]).encode()).hexdigest()
+
+
+def compute_neighbors_exact(X, n_neighbors=30, metric='euclidean', metric_kwds={}, block_size=None, n_jobs=None):
+    """Exact kNN of all cells from a single query, done for blocks of cells in parallel.
+
+    Returns int32 indices and distances (n_obs x n_neighbors + 1) sorted by distance, each cell being its own first
+    neighbor as in the umap layout. As in `NearestNeighbors.kneighbors`, a cell is not its own neighbor otherwise.
+    """
+    n_obs, block_size = X.shape[0], 10000 if block_size is None else block_size
+    from ..tools.utils import get_n_jobs
+    n_jobs = get_n_jobs(n_jobs)
+    index = fit_neighbors_index(X, metric, metric_kwds)
+
+    def query(start):
+        return index.kneighbors(X[start:start + block_size], n_neighbors + 1)
+
+    starts = range(0, n_obs, block_size)
+    if n_jobs > 1 and len(starts) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(query, starts))
+    else:
+        results = [query(start) for start in starts]
+    dists, indices = np.vstack([res[0] for res in results]), np.vstack([res[1] for res in results])
+
+    # move each cell to the front, dropping the first neighbor instead if the cell is not found (duplicates)
+    rows = np.arange(n_obs)
+    is_self = indices == rows[:, None]
+    is_other = np.ones(indices.shape, dtype=bool)
+    is_other[rows, np.where(is_self.any(1), is_self.argmax(1), 0)] = False
+    indices = np.hstack([rows[:, None], indices[is_other].reshape(n_obs, n_neighbors)]).astype(np.int32)
+    dists = np.hstack([np.zeros((n_obs, 1)), dists[is_other].reshape(n_obs, n_neighbors)]).astype(np.float32)
+    return indices, dists
+
+
+def get_neighbors_graphs(indices, dists):
+    """Distances and (binary) connectivities as kNN graphs, from kNN indices and distances in umap layout.
+    """
+    n_obs, n_neighbors = indices.shape[0], indices.shape[1] - 1
+    indptr = np.arange(0, n_obs * n_neighbors + 1, n_neighbors)
+    distances = csr_matrix((dists[:, 1:].ravel(), indices[:, 1:].ravel(), indptr), shape=(n_obs, n_obs))
+    connectivities = csr_matrix((np.ones(n_obs * n_neighbors), indices[:, 1:].ravel(), indptr), shape=(n_obs, n_obs))
+    return distances, connectivities
+
+
+def get_neighbors_rep(adata, n_pcs=30, use_rep=None, method='umap'):
+    """Representation the neighbors are computed on, chosen as by `Neighbors.compute_neighbors` or `method='sklearn'`.
+    """
+    if use_rep == 'X' or (use_rep is None and method != 'sklearn' and (n_pcs == 0 or adata.n_vars <= 50)):
+        return adata.X
+    X = adata.obsm['X_pca' if use_rep is None else use_rep]
+    return X[:, :n_pcs] if use_rep in {None, 'X_pca'} and method != 'sklearn' else X
+
+
+def fit_neighbors_index(X, metric='euclidean', metric_kwds={}):
+    from sklearn.neighbors import NearestNeighbors
+    return NearestNeighbors(metric=metric, metric_params=metric_kwds if metric_kwds else None).fit(X)
+
+
+def write_neighbors_index(adata, index):
+    """Pickles the kNN index (segments of consecutive cells with their fitted index) to `settings.cachedir`.
+    """
+    import pickle
+    from uuid import uuid4
+    params = adata.uns['neighbors']['params']
+    if 'index' not in params.keys():
+        os.makedirs(settings.cachedir, exist_ok=True)
+        params['index'] = os.path.join(settings.cachedir, 'neighbors_index_' + uuid4().hex + '.pkl')
+    with open(params['index'], 'wb') as f:
+        pickle.dump(index, f)
+
+
+def read_neighbors_index(adata, n_obs):
+    """Loads the persisted kNN index, if it exists and was fitted on the first n_obs cells.
+    """
+    import pickle
+    params = adata.uns['neighbors']['params']
+    if 'index' in params.keys() and os.path.exists(params['index']):
+        with open(params['index'], 'rb') as f:
+            index = pickle.load(f)
+        if sum(nn.n_samples_fit_ for _, nn in index['segments']) == n_obs: return index
+    return None
+
+
+def query_neighbors_index(index, X, n_neighbors):
+    """Queries all segments of the index and merges their neighbors, sorted by distance.
+    """
+    dists, indices = [], []
+    for offset, nn in index['segments']:
+        dist, ind = nn.kneighbors(X, n_neighbors=min(n_neighbors, nn.n_samples_fit_))
+        dists.append(dist)
+        indices.append(ind + offset)
+    dists, indices = np.hstack(dists), np.hstack(indices)
+    order = np.argsort(dists, axis=1, kind='stable')[:, :n_neighbors]
+    return np.take_along_axis(dists, order, 1), np.take_along_axis(indices, order, 1)
+
+
+def get_knn(adata):
+    """kNN indices and distances of the existing graph in umap layout (sorted by distance, each cell being its own
+    first neighbor).
+    """
+    D = csr_matrix(adata.uns['neighbors']['distances'])
+    if 'indices' in adata.uns['neighbors'].keys():
+        indices = np.array(adata.uns['neighbors']['indices'])
+        rows = np.repeat(np.arange(D.shape[0]), indices.shape[1])
+        dists = np.asarray(D[rows, indices.ravel()]).reshape(indices.shape)
+    else:  # kNN graph of method `sklearn` computed without indices
+        n_obs, n_neighbors = D.shape[0], D.indptr[1]
+        indices, dists = D.indices.reshape(-1, n_neighbors), D.data.reshape(-1, n_neighbors)
+        order = np.argsort(dists, axis=1, kind='stable')
+        indices, dists = np.take_along_axis(indices, order, 1), np.take_along_axis(dists, order, 1)
+        indices, dists = np.hstack([np.arange(n_obs)[:, None], indices]), np.hstack([np.zeros((n_obs, 1)), dists])
+    return indices, dists
+
+
+def update_neighbors(adata, n_pcs=30, use_rep=None, metric='euclidean', metric_kwds={}):
+    """Appends the rows of new cells (those beyond the existing graph) to the neighbor graph, querying them against
+    the persisted index, and adds them as neighbors to existing cells they are closer to (reverse edges). For exact
+    (`sklearn`) neighbors on the same representation, the graph is the same as if it had been computed on all cells.
+    """
+    params = adata.uns['neighbors']['params']
+    method, n_neighbors, n_pcs = params['method'], params['n_neighbors'], params.get('n_pcs', n_pcs)
+    use_rep, metric = params.get('use_rep', use_rep), params.get('metric', metric)
+    if method not in {'umap', 'sklearn'}:
+        raise ValueError('Incremental neighbors are only supported for method `umap` or `sklearn`.')
+    knn_indices, knn_dists = get_knn(adata)
+    n_obs_old, n_obs = knn_indices.shape[0], adata.n_obs
+    new_idx = np.arange(n_obs_old, n_obs)
+    if 'obs_key' not in params.keys():
+        logg.warn('Cannot verify that the cells of the neighbor graph come first, as it has no `obs_key`.')
+    elif params['obs_key'] != get_obs_key(adata, n_obs_old):
+        raise ValueError('The first ' + str(n_obs_old) + ' cells do not match the cells of the neighbor graph. '
+                         'New cells need to be appended after them for incremental neighbors.')
+
+    index = read_neighbors_index(adata, n_obs_old)
+    use_pca = use_rep in {None, 'X_pca'} and 'PCs' in adata.varm.keys()
+    if use_pca:  # project new cells onto the existing principal components
+        mean = np.asarray(adata.X[:n_obs_old].mean(0), dtype=np.float32).ravel() if index is None else index['mean']
+        X_pca = np.zeros((n_obs, adata.varm['PCs'].shape[1]), dtype=np.float32)
+        has_pca = 'X_pca' in adata.obsm.keys() and adata.obsm['X_pca'].shape[1] == X_pca.shape[1]
+        if has_pca: X_pca[:n_obs_old] = adata.obsm['X_pca'][:n_obs_old]
+        for start in range(n_obs_old if has_pca else 0, n_obs, 10000):
+            X = adata.X[start:start + 10000]
+            X_pca[start:start + 10000] = ((X.A if issparse(X) else np.asarray(X)) - mean).dot(adata.varm['PCs'])
+        adata.obsm['X_pca'] = X_pca
+    X = get_neighbors_rep(adata, n_pcs, use_rep, method)
+    if index is None:
+        index = {'mean': mean if use_pca else None,
+                 'segments': [(0, fit_neighbors_index(X[:n_obs_old], metric, metric_kwds))]}
+    X_new = X[n_obs_old:]
+
+    index_new = fit_neighbors_index(X_new, metric, metric_kwds)
+    index['segments'].append((n_obs_old, index_new))
+    if len(index['segments']) > 10:  # compact the index once it consists of too many segments
+        index['segments'] = [(0, fit_neighbors_index(X, metric, metric_kwds))]
+
+    # neighbors of new cells, each cell being its own first neighbor
+    n_knn = knn_indices.shape[1]
+    dists, indices = query_neighbors_index(index, X_new, n_knn)
+    dists[indices == new_idx[:, None]] = np.inf
+    order = np.argsort(dists, axis=1, kind='stable')[:, :n_knn - 1]
+    dists, indices = np.take_along_axis(dists, order, 1), np.take_along_axis(indices, order, 1)
+    dists = np.hstack([np.zeros((len(new_idx), 1)), dists])
+    indices = np.hstack([new_idx[:, None], indices])
+
+    # reverse edges: existing cells, queried against the new cells only, adopt those closer than their neighbors
+    dists_old, indices_old = index_new.kneighbors(X[:n_obs_old], min(n_knn, len(new_idx)))
+    indices_old = np.hstack([knn_indices, indices_old + n_obs_old])
+    dists_old = np.hstack([knn_dists, dists_old])
+    dists_old[:, 0] = -1  # keep each cell first
+    order = np.argsort(dists_old, axis=1, kind='stable')[:, :n_knn]
+    dists_old[:, 0] = 0
+    knn_indices = np.vstack([np.take_along_axis(indices_old, order, 1), indices]).astype(np.int32)
+    knn_dists = np.vstack([np.take_along_axis(dists_old, order, 1), dists]).astype(np.float32)
+
+    C_old = adata.uns['neighbors']['connectivities']
+    if method == 'umap':
+        from scanpy.neighbors import compute_connectivities_umap
+        distances, connectivities = compute_connectivities_umap(knn_indices, knn_dists, n_obs, n_neighbors)
+    else:
+        distances, connectivities = get_neighbors_graphs(knn_indices, knn_dists)
+    adata.uns['neighbors']['distances'], adata.uns['neighbors']['connectivities'] = distances, connectivities
+    adata.uns['neighbors']['indices'] = knn_indices
+
+    C_new = csr_matrix(connectivities[:n_obs_old]) > 0
+    changed = (C_new[:, :n_obs_old] != (C_old > 0)).getnnz(1) + C_new[:, n_obs_old:].getnnz(1) > 0
+    adata.uns['neighbors']['updated_cells'] = np.concatenate([np.where(changed)[0], new_idx])
+    params['obs_key'], params['version'] = get_obs_key(adata), get_graph_version(adata) + 1
+    write_neighbors_index(adata, index)
+
+
+def select_neighbors(dist, n_neighbors=None, largest=False):
+    """Keeps the n_neighbors smallest (or largest) entries in each row of a sparse matrix, vectorized over all rows:
+    argpartition of the reshaped data if all rows have the same number of entries, a lexsort by (row, value) otherwise.
+
+    Ties are resolved as by the former per-row argsort: the first tied entries of a row are kept for the smallest,
+    the last ones for the largest entries (e.g. with binary connectivities).
+    """
+    D = csr_matrix(dist, copy=True)
     D.eliminate_zeros()
+    n_counts = np.diff(D.indptr)
+    n_neighbors = n_counts.min() if n_neighbors is None else min(n_counts.min(), n_neighbors)
+    if n_counts.max() <= n_neighbors: return D
+
+    dat, keep = -D.data if largest else D.data, np.zeros(D.nnz, dtype=bool)
+    if n_counts.min() == n_counts.max():
+        dat = dat.reshape(-1, n_counts[0])
+        kth = np.partition(dat, max(n_neighbors - 1, 0), axis=1)[:, max(n_neighbors - 1, 0), None]
+        is_tied = dat == kth
+        n_tied = np.cumsum(is_tied[:, ::-1], axis=1)[:, ::-1] if largest else np.cumsum(is_tied, axis=1)
+        n_missing = n_neighbors - (dat < kth).sum(1, keepdims=True)
+        keep = ((dat < kth) | (is_tied & (n_tied <= n_missing))).ravel()
+    else:
+        rows = np.repeat(np.arange(D.shape[0]), n_counts)
+        order = np.lexsort((-np.arange(D.nnz) if largest else np.arange(D.nnz), dat, rows))
+        keep[order[np.arange(D.nnz) - D.indptr[rows] < n_neighbors]] = True
+
+    D.data, D.indices = D.data[keep], D.indices[keep]
+    D.indptr = np.insert(np.minimum(n_counts, n_neighbors).cumsum(), 0, 0).astype(D.indptr.dtype)
     return D
 
 
-def select_connectivities(connectivities, n_neighbors=None):
-    C = connectivities.copy()
-    n_counts = (C > 0).sum(1).A1 if issparse(C) else (C > 0).sum(1)
-    n_neighbors = n_counts.min() if n_neighbors is None else min(n_counts.min(), n_neighbors)
-    rows = np.where(n_counts > n_neighbors)[0]
-    cumsum_neighs = np.insert(n_counts.cumsum(), 0, 0)
-    dat = C.data
+def select_distances(dist, n_neighbors=None):
+    return select_neighbors(dist, n_neighbors)
 
-    for row in rows:
-        n0, n1 = cumsum_neighs[row], cumsum_neighs[row + 1]
-        rm_idx = n0 + dat[n0:n1].argsort()[::-1][n_neighbors:]
-        dat[rm_idx] = 0
-    C.eliminate_zeros()
-    return C
+
+def select_connectivities(connectivities, n_neighbors=None):
+    return select_neighbors(connectivities, n_neighbors, largest=True)
 
 
 def neighbors_to_be_recomputed(adata, n_neighbors=None):
@@ -136,9 +374,38 @@ def neighbors_to_be_recomputed(adata, n_neighbors=None):
     return result
 
 
-def get_connectivities(adata, mode='connectivities', n_neighbors=None, recurse_neighbors=False):
+_connectivities_cache = OrderedDict()
+
+
+def get_graph_version(adata):
+    """Version of the neighbor graph, incremented by `pp.neighbors` each time it is computed or updated (0 if unknown)
+    """
+    return adata.uns['neighbors'].get('params', {}).get('version', 0)
+
+
+def clear_connectivities_cache(neighbors_id=None):
+    for key in [key for key in _connectivities_cache if neighbors_id is None or key[0] == neighbors_id]:
+        _connectivities_cache.pop(key, None)
+
+
+def get_connectivities(adata, mode='connectivities', n_neighbors=None, recurse_neighbors=False, max_cache_size=10):
+    """Row-normalized connectivities, cached per neighbor graph and (mode, n_neighbors, recurse_neighbors).
+
+    The cache is keyed by the id of `adata.uns['neighbors'][mode]` and the graph version set by `pp.neighbors`, and
+    keeps the max_cache_size most recently used entries. Entries are released once that matrix is garbage collected,
+    i.e. when neighbors are recomputed. The graph and the returned matrix must not be modified in place.
+    """
     C = adata.uns['neighbors'][mode]
-    if n_neighbors is not None and n_neighbors < adata.uns['neighbors']['params']['n_neighbors']:
+    if n_neighbors is not None and n_neighbors >= adata.uns['neighbors']['params']['n_neighbors']: n_neighbors = None
+    key = (id(C), get_graph_version(adata), mode, n_neighbors, recurse_neighbors)
+    if key in _connectivities_cache:
+        _connectivities_cache.move_to_end(key)
+        return _connectivities_cache[key]
+    for stale_key in [cached for cached in _connectivities_cache if cached[0] == key[0] and cached[1] != key[1]]:
+        del _connectivities_cache[stale_key]  # the graph was updated in place
+
+    neighbors_graph = C
+    if n_neighbors is not None:
         C = select_connectivities(C, n_neighbors) if mode == 'connectivities' else select_distances(C, n_neighbors)
     connectivities = C > 0
     connectivities.setdiag(1)
@@ -146,4 +413,11 @@ def get_connectivities(adata, mode='connectivities', n_neighbors=None, recurse_n
         connectivities += connectivities.dot(connectivities * .5)
         connectivities.data = np.clip(connectivities.data, 0, 1)
     connectivities = connectivities.multiply(1. / connectivities.sum(1))
-    return connectivities.tocsr().astype(np.float32)
\ No newline at end of file
+    connectivities = connectivities.tocsr().astype(np.float32)
+
+    if not any(cached[0] == key[0] for cached in _connectivities_cache):
+        weakref.finalize(neighbors_graph, clear_connectivities_cache, key[0])
+    _connectivities_cache[key] = connectivities
+    while len(_connectivities_cache) > max_cache_size:
+        _connectivities_cache.popitem(last=False)
+    return connectivities
@@ -45,7 +45,7 @@ figdir = './figures/'
 
 max_memory = 15
 """Maximal memory usage in Gigabyte.
-Is currently not well respected....
+Used to size blocks of cells in `tl.velocity_graph`. Is currently not well respected elsewhere....
 """
 
 n_jobs = 1
@@ -7,4 +7,4 @@ from .terminal_states import cell_fate, cell_origin, eigs, terminal_states
 from .rank_velocity_genes import velocity_clusters, rank_velocity_genes
 from .velocity_pseudotime import velocity_map, velocity_pseudotime
 from scanpy.api.tl import tsne, umap, diffmap, louvain, paga
-from .dynamical_model import DynamicsRecovery, recover_dynamics
+from .dynamical_model import DynamicsRecovery, DynamicsRecoveryBatch, recover_dynamics
@@ -1,39 +1,51 @@
 from .. import settings
 from .. import logging as logg
-from .utils import make_dense, make_unique_list
+from ..preprocessing.moments import get_moments
+from ..preprocessing.neighbors import get_obs_key
+from .utils import make_dense, make_unique_list, get_n_jobs
 from .dynamical_model_utils import BaseDynamics, unspliced, spliced, vectorize, derivatives, \
-    find_swichting_time, fit_alpha, fit_scaling, linreg, convolve, assign_timepoints
+    find_swichting_time, fit_alpha, fit_scaling, linreg, convolve, assign_timepoints, sum_masked, masked_percentile, \
+    find_swichting_time_batch, assign_timepoints_batch, fit_alpha_batch, fit_scaling_batch
 
+from scipy.sparse import issparse
+from numpy.lib.format import open_memmap
 import numpy as np
+import os
 import matplotlib.pyplot as pl
 from matplotlib import rcParams
 
 
 class DynamicsRecovery(BaseDynamics):
-    def __init__(self, adata=None, gene=None, u=None, s=None, use_raw=False, load_pars=None):
-        super(DynamicsRecovery, self).__init__(adata.n_obs)
+    def __init__(self, adata=None, gene=None, u=None, s=None, use_raw=False, load_pars=None, u_raw=None, s_raw=None,
+                 weights=None):
+        super(DynamicsRecovery, self).__init__(adata.n_obs if adata is not None else len(u))
 
-        _layers = adata[:, gene].layers
-        self.use_raw = use_raw = use_raw or 'Ms' not in _layers.keys()
+        _layers = adata[:, gene].layers if adata is not None else {}
+        self.use_raw = use_raw = use_raw or (adata is not None and 'Ms' not in _layers.keys()
+                                             and 'moments' not in adata.uns.keys())
 
         # extract actual data
         if u is None or s is None:
-            u = make_dense(_layers['unspliced']) if use_raw else make_dense(_layers['Mu'])
-            s = make_dense(_layers['spliced']) if use_raw else make_dense(_layers['Ms'])
+            u = make_dense(_layers['unspliced']) if use_raw else make_dense(get_moments(adata, 'Mu', gene))
+            s = make_dense(_layers['spliced']) if use_raw else make_dense(get_moments(adata, 'Ms', gene))
         self.s, self.u = s, u
 
-        s_raw = s if use_raw else make_dense(_layers['spliced'])
-        u_raw = u if use_raw else make_dense(_layers['unspliced'])
+        if weights is None:
+            s_raw = s if use_raw else make_dense(_layers['spliced']) if s_raw is None else s_raw
+            u_raw = u if use_raw else make_dense(_layers['unspliced']) if u_raw is None else u_raw
 
-        # set weights for fitting (exclude dropouts and extreme outliers)
-        s_filter = np.ravel(s_raw > 0)
-        u_filter = np.ravel(u_raw > 0)
-        s_filter &= np.ravel(s < np.percentile(s[s_filter], 99))
-        u_filter &= np.ravel(u < np.percentile(u[u_filter], 99))
+            # set weights for fitting (exclude dropouts and extreme outliers)
+            s_filter = np.ravel(s_raw > 0)
+            u_filter = np.ravel(u_raw > 0)
+            s_filter &= np.ravel(s < np.percentile(s[s_filter], 99))
+            u_filter &= np.ravel(u < np.percentile(u[u_filter], 99))
+            weights = s_filter & u_filter
 
-        self.weights = s_filter & u_filter
+        self.weights = weights
 
-        if load_pars and 'fit_alpha' in adata.var.keys():
+        if load_pars is not None and not isinstance(load_pars, bool):  # fitted (alpha, beta, gamma, t_, scaling, t)
+            self.load_pars(pars=load_pars)
+        elif load_pars and 'fit_alpha' in adata.var.keys():
             self.load_pars(adata, gene)
         else:
             self.initialize()
@@ -65,14 +77,13 @@ class DynamicsRecovery(BaseDynamics):
         self.update_state_dependent()
         self.update_scaling()
 
-    def load_pars(self, adata, gene):
-        idx = np.where(adata.var_names == gene)[0][0] if isinstance(gene, str) else gene
-        self.alpha = adata.var['fit_alpha'][idx]
-        self.beta = adata.var['fit_beta'][idx]
-        self.gamma = adata.var['fit_gamma'][idx]
-        self.scaling = adata.var['fit_scaling'][idx]
-        self.t_ = adata.var['fit_t_'][idx]
-        self.t = adata.layers['fit_t'][:, idx]
+    def load_pars(self, adata=None, gene=None, pars=None):
+        if pars is None:
+            idx = np.where(adata.var_names == gene)[0][0] if isinstance(gene, str) else gene
+            pars = [adata.var['fit_' + name][idx] for name in ['alpha', 'beta', 'gamma', 't_', 'scaling']]
+            pars.append(adata.layers['fit_t'][:, idx])
+        self.alpha, self.beta, self.gamma, self.t_, self.scaling, self.t = pars
+        self.pars = np.array([self.alpha, self.beta, self.gamma, self.t_, self.scaling])[:, None]
 
         self.u0, self.s0, self.alpha_ = 0, 0, 0
         self.u0_ = unspliced(self.t_, self.u0, self.alpha, self.beta)
@@ -104,16 +115,14 @@ class DynamicsRecovery(BaseDynamics):
         t0_ = find_swichting_time(u_w, s_w, tau_w, o_w, alpha, beta, gamma)
 
         t0_vals = t0_ + np.linspace(-1, 1, num=5) * t0_ / 10
-        for t0_ in t0_vals:
-            improved_tau = improved_tau or self.update_loss(t_=t0_, reassign_time=True)  # update if improved
+        improved_tau = self.update_loss_grid(t_=t0_vals)  # update with the first value that improves
 
         # fit alpha (generalized lin.reg)
         tau_w, o_w = (self.tau, self.o) if w is None else (self.tau[w], self.o[w])
         alpha = fit_alpha(u_w, s_w, tau_w, o_w, beta, gamma)
 
         alpha_vals = alpha + np.linspace(-1, 1, num=5) * alpha / 10
-        for alpha in alpha_vals:
-            improved_alpha = improved_alpha or self.update_loss(alpha=alpha, reassign_time=True)  # update if improved
+        improved_alpha = self.update_loss_grid(alpha=alpha_vals)  # update with the first value that improves
 
         # fit scaling (generalized lin.reg)
         t_w, tau_w, o_w = (self.t, self.tau, self.o) if w is None else (self.t[w], self.tau[w], self.o[w])
@@ -232,21 +241,336 @@ class DynamicsRecovery(BaseDynamics):
 
         return perform_update
 
-    def shuffle_pars(self, alpha_sight=[-.5, .5], gamma_sight=[-.5, .5], num=5):
+    def get_grid_size(self, grid_size=None):
+        """Number of grid points evaluated at once, such that the (grid_size x n_obs) arrays of a chunk stay small,
+        as times are assigned to all cells for each grid point.
+        """
+        return max(1, int(2 ** 14 / len(self.u))) if grid_size is None else grid_size
+
+    def update_loss_grid(self, t_=None, alpha=None, grid_size=None):
+        """Same as calling `update_loss(t_=t_[i], alpha=alpha[i], reassign_time=True)` for each grid point i in turn
+        until the loss improves, with the losses evaluated at once for chunks of `grid_size` grid points.
+        """
+        n_grid = len(alpha if t_ is None else t_)
+        grid_size = self.get_grid_size(grid_size)
+
+        for start in range(0, n_grid, grid_size):
+            loss_prev = self.loss[-1] if len(self.loss) > 0 else 1e6
+            t_grid, alpha_grid = [None if x is None else x[start:start + grid_size] for x in (t_, alpha)]
+            t_grid, t, _, _ = self.get_time_assignment_grid(t_grid, alpha_grid)
+            loss = self.get_loss_grid(t, t_grid, alpha_grid)
+
+            # grid points up to the first improving one are recorded as separate updates
+            improved = loss < loss_prev
+            i = np.argmax(improved) if improved.any() else len(loss)
+            pars = np.array([self.alpha, self.beta, self.gamma, self.t_, self.scaling])[:, None]
+            self.pars = np.c_[self.pars, np.repeat(pars, i, axis=1)]
+            self.loss.extend([loss_prev] * i)
+
+            if i < len(loss):
+                self.t, self.t_ = np.array(t[i]), t_grid[i]
+                self.o = o = np.array(self.t <= self.t_, dtype=bool)
+                self.tau = self.t * o + (self.t - self.t_) * (1 - o)
+                if alpha is not None: self.alpha = alpha_grid[i]
+
+                pars = np.array([self.alpha, self.beta, self.gamma, self.t_, self.scaling])[:, None]
+                self.pars = np.c_[self.pars, pars]
+                self.loss.append(loss[i])
+                return True
+        return False
+
+    def shuffle_pars(self, alpha_sight=[-.5, .5], gamma_sight=[-.5, .5], num=5, grid_size=None):
         alpha_vals = np.linspace(alpha_sight[0], alpha_sight[1], num=num) * self.alpha + self.alpha
         gamma_vals = np.linspace(gamma_sight[0], gamma_sight[1], num=num) * self.gamma + self.gamma
 
         x, y = alpha_vals, gamma_vals
-        f = lambda x, y: self.get_loss(alpha=x, gamma=y, reassign_time=True)
-        z = np.zeros((len(x), len(x)))
+        x_grid, y_grid = np.repeat(x, len(y)), np.tile(y, len(x))
+        grid_size = self.get_grid_size(grid_size)
+        z = np.concatenate([self.get_loss_grid(alpha=x_grid[i:i + grid_size], gamma=y_grid[i:i + grid_size],
+                                               reassign_time=True) for i in range(0, len(x_grid), grid_size)])
+        z = z.reshape(len(x), len(y))
 
-        for i, xi in enumerate(x):
-            for j, yi in enumerate(y):
-                z[i, j] = f(xi, yi)
         ix, iy = np.unravel_index(z.argmin(), z.shape)
         return self.update_loss(alpha=x[ix], gamma=y[ix], reassign_time=True)
 
 
+class DynamicsRecoveryBatch:
+    """Dynamics recovery of a batch of genes at once, following the steps of `DynamicsRecovery` for each gene.
+
+    u, s, t, tau and o are (n_obs x n_genes) arrays and the parameters are vectors with one entry per gene. Each step
+    is evaluated for all genes in one pass, restricted to those genes which take the step in the gene-wise fit (e.g.
+    which have not converged yet), while the weights (cells used for fitting) are applied as a mask per gene.
+
+    This is an approximation of the gene-wise fit: sums over masked columns are reduced in a different order than
+    over the selected cells of a single gene. The resulting differences in rounding change accept/reject decisions of
+    single steps, such that a gene may take a different path, reach a different (local) optimum and yield a loss
+    trace of different length than with `DynamicsRecovery`.
+    """
+    def __init__(self, adata=None, genes=None, u=None, s=None, use_raw=False, load_pars=None, u_raw=None, s_raw=None,
+                 weights=None):
+        _layers = adata[:, genes].layers if adata is not None else {}
+        self.use_raw = use_raw = use_raw or (adata is not None and 'Ms' not in _layers.keys()
+                                             and 'moments' not in adata.uns.keys())
+        dense = lambda X: np.asfortranarray(X.A if issparse(X) else X)  # column-major to reduce over cells per gene
+
+        # extract actual data
+        if u is None or s is None:
+            u = _layers['unspliced'] if use_raw else get_moments(adata, 'Mu', genes)
+            s = _layers['spliced'] if use_raw else get_moments(adata, 'Ms', genes)
+        u, s = dense(u), dense(s)
+        self.s, self.u, self.n_vars = s, u, u.shape[1]
+
+        if weights is None:  # set weights for fitting (exclude dropouts and extreme outliers)
+            s_raw = s if use_raw else dense(_layers['spliced'] if s_raw is None else s_raw)
+            u_raw = u if use_raw else dense(_layers['unspliced'] if u_raw is None else u_raw)
+            weights = get_fit_weights(u, s, u_raw, s_raw)
+        self.weights = dense(weights)
+
+        # per-gene loss trace (with parameters), last loss and last five losses to check for convergence
+        self.trace, self.loss_last, self.loss_recent = [], np.ones(self.n_vars) * 1e6, np.ones((5, self.n_vars)) * 1e6
+        self.m_dpars, self.v_dpars = np.zeros((3, self.n_vars)), np.zeros((3, self.n_vars))
+        self.n_dpars = np.ones(self.n_vars, dtype=int)
+
+        if load_pars is not None and not isinstance(load_pars, bool):  # fitted (alpha, beta, gamma, t_, scaling, t)
+            self.load_pars(pars=load_pars)
+        elif load_pars and 'fit_alpha' in adata.var.keys():
+            self.load_pars(adata, genes)
+        else:
+            self.initialize()
+
+    def initialize(self):
+        self.scaling = self.u.sum(0) / self.s.sum(0) * 1.3
+        u, s, w, perc = self.u / self.scaling, self.s, self.weights, 95
+        # initialize beta and gamma from extreme quantiles of s
+        weights_s = w & (s >= masked_percentile(s, w, perc))
+        beta, gamma = np.ones(self.n_vars, dtype=u.dtype), sum_masked(u * s, weights_s) / sum_masked(s ** 2, weights_s)
+
+        # initialize alpha and switching points from extreme quantiles of u
+        weights_u = w & (u >= masked_percentile(u, w, perc))
+        n_u = weights_u.sum(0)
+        u0_, s0_ = (sum_masked(u, weights_u) / n_u).astype(u.dtype), (sum_masked(s, weights_u) / n_u).astype(s.dtype)
+        alpha, alpha_, u0, s0, = u0_.copy(), 0, 0, 0
+
+        t, tau, o = assign_timepoints_batch(u, s, alpha, beta, gamma, u0_=u0_, s0_=s0_)
+
+        # update object with initialized vars
+        self.alpha, self.beta, self.gamma, self.alpha_ = alpha, beta, gamma, alpha_
+        self.u0, self.s0, self.u0_, self.s0_ = u0, s0, u0_, s0_
+        self.t, self.tau, self.o, self.t_ = t, tau, o, (tau * o).max(0)
+
+        idx = np.arange(self.n_vars)
+        self.record(idx, self.get_loss(idx))
+        self.update_state_dependent(idx)
+        self.update_scaling(idx)
+
+    def load_pars(self, adata=None, genes=None, pars=None):
+        if pars is None:
+            idx = adata.var_names.get_indexer(genes)
+            pars = [adata.var['fit_' + name].values[idx] for name in ['alpha', 'beta', 'gamma', 't_', 'scaling']]
+            pars.append(adata.layers['fit_t'][:, idx])
+        self.alpha, self.beta, self.gamma, self.t_, self.scaling = [np.array(par) for par in pars[:5]]
+        self.t = np.array(pars[5], order='F')
+        self.tau, self.o = np.zeros(self.t.shape), np.zeros(self.t.shape, dtype=int)
+
+        self.u0, self.s0, self.alpha_ = 0, 0, 0
+        self.u0_ = unspliced(self.t_, self.u0, self.alpha, self.beta)
+        self.s0_ = spliced(self.t_, self.u0, self.s0, self.alpha, self.beta, self.gamma)
+        self.update_state_dependent(np.arange(self.n_vars))
+
+    def record(self, idx, loss):
+        self.loss_last[idx] = loss
+        self.loss_recent[:, idx] = np.vstack([self.loss_recent[1:, idx], loss])
+        pars = [self.alpha[idx], self.beta[idx], self.gamma[idx], self.t_[idx], self.scaling[idx]]
+        self.trace.append((idx, np.vstack([loss] + pars)))
+
+    def get_traces(self):
+        """Loss trace and trace of parameters (alpha, beta, gamma, t_, scaling) for each gene, as in
+        `DynamicsRecovery.loss` and `DynamicsRecovery.pars`.
+        """
+        idx = np.concatenate([idx for idx, _ in self.trace])
+        order = np.argsort(idx, kind='stable')
+        vals = np.hstack([vals for _, vals in self.trace])[:, order]
+        vals = np.split(vals, np.searchsorted(idx[order], np.arange(1, self.n_vars)), axis=1)
+        return [val[0] for val in vals], [val[1:] for val in vals]
+
+    def fit(self, max_iter=100, r=None, method=None, clip_loss=None):
+        improved, idx_update = np.ones(self.n_vars, dtype=bool), np.clip(int(max_iter / 10), 1, None)
+        active = np.ones(self.n_vars, dtype=bool)
+
+        for i in range(max_iter):
+            idx = np.where(active)[0]
+            self.update_vars(idx, r=r, method=method, clip_loss=clip_loss)
+            update = improved[idx] | (i % idx_update == 1) | (i == max_iter - 1)
+            if update.any():
+                improved[idx[update]] = self.update_state_dependent(idx[update])
+            if i > 5:
+                loss_prev, loss = self.loss_recent[:, idx].max(0), self.loss_last[idx]
+                converged = idx[loss_prev - loss < loss_prev * .001]
+                if len(converged) > 0:
+                    improved[converged] = self.shuffle_pars(converged)
+                    active[converged[~improved[converged]]] = False
+            if not active.any():
+                break
+
+    def update_state_dependent(self, idx):
+        u, s, w = self.u[:, idx] / self.scaling[idx], self.s[:, idx], self.weights[:, idx]
+        beta, gamma = self.beta[idx], self.gamma[idx]
+
+        improved_tau, improved_alpha = np.zeros(len(idx), dtype=bool), np.zeros(len(idx), dtype=bool)
+        # find optimal switching (generalized lin.reg) & assign timepoints/states (explicit)
+        t0_ = find_swichting_time_batch(u, s, self.tau[:, idx], self.o[:, idx], self.alpha[idx], beta, gamma, w)
+
+        t0_vals = t0_ + np.linspace(-1, 1, num=5)[:, None] * t0_ / 10
+        for t0_ in t0_vals:  # until improved for each gene
+            if not improved_tau.all():
+                improved_tau[~improved_tau] = self.update_loss(idx[~improved_tau], t_=t0_[~improved_tau],
+                                                               reassign_time=True)
+
+        # fit alpha (generalized lin.reg)
+        alpha = fit_alpha_batch(u, s, self.tau[:, idx], self.o[:, idx], beta, gamma, w)
+
+        alpha_vals = alpha + np.linspace(-1, 1, num=5)[:, None] * alpha / 10
+        for alpha in alpha_vals:  # until improved for each gene
+            if not improved_alpha.all():
+                improved_alpha[~improved_alpha] = self.update_loss(idx[~improved_alpha], alpha=alpha[~improved_alpha],
+                                                                   reassign_time=True)
+
+        # fit scaling (generalized lin.reg)
+        scaling = fit_scaling_batch(u, self.t[:, idx], self.t_[idx], self.alpha[idx], beta, w)
+        improved_scaling = self.update_loss(idx, scaling=scaling * self.scaling[idx], reassign_time=True)
+
+        return improved_tau | improved_alpha | improved_scaling
+
+    def update_scaling(self, idx):
+        # fit scaling and update if improved
+        u, s, tau, o = self.u[:, idx] / self.scaling[idx], self.s[:, idx], self.tau[:, idx], self.o[:, idx]
+        beta, gamma, t_ = self.beta[idx], self.gamma[idx], self.t_[idx]
+
+        # fit alpha and scaling and update if improved
+        alpha = fit_alpha_batch(u, s, tau, o, beta, gamma)
+        t0_ = find_swichting_time_batch(u, s, tau, o, alpha, beta, gamma)
+        t, tau, o = assign_timepoints_batch(u, s, alpha, beta, gamma, t0_)
+        improved_alpha = self.update_loss(idx, t, t0_, alpha=alpha)
+
+        # fit scaling and update if improved
+        scaling = fit_scaling_batch(u, t, t_, alpha, beta) * self.scaling[idx]
+        t0_ = find_swichting_time_batch(u, s, tau, o, alpha, beta, gamma)
+        t, tau, o = assign_timepoints_batch(u, s, alpha, beta, gamma, t0_)
+        improved_scaling = self.update_loss(idx, t, t0_, scaling=scaling)
+
+        return improved_alpha | improved_scaling
+
+    def update_vars(self, idx, r=None, method=None, clip_loss=None):
+        if r is None:
+            r = 1e-2 if method == 'adam' else 1e-6
+        if clip_loss is None:
+            clip_loss = False if method == 'adam' else True
+        t, t_, alpha, beta, gamma = self.t[:, idx], self.t_[idx], self.alpha[idx], self.beta[idx], self.gamma[idx]
+        dalpha, dbeta, dgamma, dalpha_, dtau, dt_ = \
+            derivatives(self.u[:, idx], self.s[:, idx], t, t_, alpha, beta, gamma, self.scaling[idx])
+
+        if method == 'adam':
+            b1, b2, eps = 0.9, 0.999, 1e-8
+
+            # update 1st and 2nd order gradient moments
+            dpars = np.array([dalpha, dbeta, dgamma])
+            m_dpars = self.m_dpars[:, idx] = b1 * self.m_dpars[:, idx] + (1 - b1) * dpars
+            v_dpars = self.v_dpars[:, idx] = b2 * self.v_dpars[:, idx] + (1 - b2) * dpars ** 2
+
+            # correct for bias (number of updates of each gene)
+            self.n_dpars[idx] += 1
+            n_dpars = self.n_dpars[idx]
+            m_dpars, v_dpars = m_dpars / (1 - b1 ** n_dpars), v_dpars / (1 - b2 ** n_dpars)
+
+            # Adam parameter update
+            alpha = alpha - r * m_dpars[0] / (np.sqrt(v_dpars[0]) + eps)
+            beta = beta - r * m_dpars[1] / (np.sqrt(v_dpars[1]) + eps)
+            gamma = gamma - r * m_dpars[2] / (np.sqrt(v_dpars[2]) + eps)
+
+        else:
+            alpha, beta, gamma = alpha - r * dalpha, beta - r * dbeta, gamma - r * dgamma
+
+        self.update_loss(idx, alpha=alpha, beta=beta, gamma=gamma, clip_loss=clip_loss)
+
+    def update_loss(self, idx, t=None, t_=None, alpha=None, beta=None, gamma=None, scaling=None, reassign_time=False,
+                    clip_loss=True):
+        loss_prev = self.loss_last[idx]
+
+        if reassign_time:
+            t_ = self.get_optimal_switch(idx, alpha, beta, gamma) if t_ is None else t_
+            t, tau, o = self.get_time_assignment(idx, t_, alpha, beta, gamma)
+
+        loss = self.get_loss(idx, t, t_, alpha, beta, gamma, scaling)
+        perform_update = np.ones(len(idx), dtype=bool) if not clip_loss else loss < loss_prev
+        idx_update = idx[perform_update]
+
+        if t_ is not None or reassign_time:
+            t, t_ = t[:, perform_update], t_[perform_update]
+            self.t[:, idx_update], self.t_[idx_update] = t, t_
+            self.o[:, idx_update] = o = np.array(t <= t_, dtype=bool)
+            self.tau[:, idx_update] = t * o + (t - t_) * (1 - o)
+
+        if alpha is not None: self.alpha[idx_update] = alpha[perform_update]
+        if beta is not None: self.beta[idx_update] = beta[perform_update]
+        if gamma is not None: self.gamma[idx_update] = gamma[perform_update]
+        if scaling is not None: self.scaling[idx_update] = scaling[perform_update]
+
+        self.record(idx, np.where(perform_update, loss, loss_prev))
+        return perform_update
+
+    def shuffle_pars(self, idx, alpha_sight=[-.5, .5], gamma_sight=[-.5, .5], num=5):
+        alpha_vals = np.linspace(alpha_sight[0], alpha_sight[1], num=num)[:, None] * self.alpha[idx] + self.alpha[idx]
+        gamma_vals = np.linspace(gamma_sight[0], gamma_sight[1], num=num)[:, None] * self.gamma[idx] + self.gamma[idx]
+
+        x, y = alpha_vals, gamma_vals
+        z = np.zeros((len(x), len(x), len(idx)))
+
+        for i, xi in enumerate(x):
+            for j, yi in enumerate(y):
+                z[i, j] = self.get_loss(idx, alpha=xi, gamma=yi, reassign_time=True)
+        ix = z.reshape(-1, len(idx)).argmin(0) // len(x)
+        cols = np.arange(len(idx))
+        return self.update_loss(idx, alpha=x[ix, cols], gamma=y[ix, cols], reassign_time=True)
+
+    def get_optimal_switch(self, idx, alpha=None, beta=None, gamma=None):
+        u, s, tau, o, w = self.u[:, idx] / self.scaling[idx], self.s[:, idx], self.tau[:, idx], self.o[:, idx], \
+            self.weights[:, idx]
+        return find_swichting_time_batch(u, s, tau, o,
+                                         self.alpha[idx] if alpha is None else alpha,
+                                         self.beta[idx] if beta is None else beta,
+                                         self.gamma[idx] if gamma is None else gamma, w)
+
+    def get_time_assignment(self, idx, t_=None, alpha=None, beta=None, gamma=None):
+        t, tau, o = assign_timepoints_batch(self.u[:, idx] / self.scaling[idx], self.s[:, idx],
+                                            self.alpha[idx] if alpha is None else alpha,
+                                            self.beta[idx] if beta is None else beta,
+                                            self.gamma[idx] if gamma is None else gamma,
+                                            self.get_optimal_switch(idx, alpha, beta, gamma) if t_ is None else t_)
+        return t, tau, o
+
+    def get_loss(self, idx, t=None, t_=None, alpha=None, beta=None, gamma=None, scaling=None, reassign_time=False):
+        alpha = self.alpha[idx] if alpha is None else alpha
+        beta = self.beta[idx] if beta is None else beta
+        gamma = self.gamma[idx] if gamma is None else gamma
+        scaling = self.scaling[idx] if scaling is None else scaling
+        t = self.t[:, idx] if t is None else t
+        u, s, w = self.u[:, idx], self.s[:, idx], self.weights[:, idx]
+
+        if reassign_time:
+            tau, o = self.tau[:, idx], self.o[:, idx]
+            t_ = find_swichting_time_batch(u / scaling, s, tau, o, alpha, beta, gamma, w) if t_ is None else t_
+            t, tau, o = assign_timepoints_batch(u / scaling, s, alpha, beta, gamma, t_, w=w)
+        else:
+            t_ = self.t_[idx] if t_ is None else t_
+
+        tau, alpha, u0, s0 = vectorize(t, t_, alpha, beta, gamma)
+
+        udiff = np.array(unspliced(tau, u0, alpha, beta) * scaling - u)
+        sdiff = np.array(spliced(tau, s0, u0, alpha, beta, gamma) - s)
+        loss = sum_masked(udiff ** 2 + sdiff ** 2, w) / w.sum(0)
+        return loss
+
+
 def read_pars(adata, pars_names=['alpha', 'beta', 'gamma', 't_', 'scaling'], key='fit'):
     pars = []
     for name in pars_names:
@@ -261,14 +585,176 @@ def write_pars(adata, pars, pars_names=['alpha', 'beta', 'gamma', 't_', 'scaling
         adata.var[add_key + '_' + name] = pars[i]
 
 
+def get_fit_weights(u, s, u_raw, s_raw, perc=99):
+    """Cells used for fitting each gene (column), excluding dropouts and extreme outliers, for all genes at once.
+    """
+    s_filter, u_filter = s_raw > 0, u_raw > 0
+    s_filter &= s < masked_percentile(s, s_filter, perc)
+    u_filter &= u < masked_percentile(u, u_filter, perc)
+    return s_filter & u_filter
+
+
+def read_dynamics_inputs(adata, idx, use_raw=False, load_pars=False, layers=None):
+    """Inputs of the fit of the genes idx as (n_genes x n_obs) arrays, each gene being a contiguous row, taken from
+    all layers in one slice each. Sparse layers are sliced column-wise as CSC (pass layers to convert them only once).
+    """
+    layers = {} if layers is None else layers
+    keys = ['unspliced', 'spliced'] + ([] if use_raw else ['Mu', 'Ms']) + (['fit_t'] if load_pars else [])
+    X = {}
+    for key in keys:
+        if key in {'Mu', 'Ms'}:
+            Y = get_moments(adata, key, idx)
+        else:
+            Y = layers[key] if key in layers.keys() else adata.layers[key]
+            Y = (Y.tocsc() if issparse(Y) else Y)[:, idx]
+        X[key] = np.ascontiguousarray((Y.A if issparse(Y) else np.asarray(Y)).T)
+    return X
+
+
+def write_dynamics_inputs(adata, var_names, use_raw=False, load_pars=False, directory=None, layers=None,
+                          chunk_size=1000):
+    """Writes the inputs of the fit as .npy memmaps (n_genes x n_obs) to directory, such that each gene is a
+    contiguous row which worker processes read instead of receiving pickled data.
+    """
+    idx, memmaps = adata.var_names.get_indexer(var_names), {}
+    for i in range(0, len(idx), chunk_size):
+        for key, Y in read_dynamics_inputs(adata, idx[i:i + chunk_size], use_raw, load_pars, layers).items():
+            if key not in memmaps.keys():
+                filename = os.path.join(directory, key + '.npy')
+                memmaps[key] = open_memmap(filename, mode='w+', dtype=Y.dtype, shape=(len(idx), Y.shape[1]))
+            memmaps[key][i:i + chunk_size] = Y
+    for X in memmaps.values():
+        X.flush()
+
+
+def fit_dynamics(X, use_raw=False, pars=None, batch_size=None, max_iter=100, learning_rate=None, **kwargs):
+    """Fits all genes (rows) of the inputs X, gene-wise or in batches, with the weights computed for all genes at once.
+    Returns the fitted parameters, time assignments, loss traces and parameter traces, and the last model.
+    """
+    u, s = (X['unspliced'], X['spliced']) if use_raw else (X['Mu'], X['Ms'])
+    weights = get_fit_weights(u.T, s.T, X['unspliced'].T, X['spliced'].T).T
+
+    fits = []
+    if batch_size is None:
+        for j in range(len(u)):
+            load = None if pars is None else [par[j] for par in pars] + [np.array(X['fit_t'][j])]
+            dm = DynamicsRecovery(u=np.array(u[j]), s=np.array(s[j]), use_raw=use_raw, load_pars=load,
+                                  weights=np.array(weights[j]))
+            if max_iter > 1:
+                dm.fit(max_iter, learning_rate, **kwargs)
+            fits.append([[dm.alpha], [dm.beta], [dm.gamma], [dm.t_], [dm.scaling], dm.t[:, None], [dm.loss],
+                         [dm.pars]])
+
+    else:
+        for j in range(0, len(u), batch_size):
+            load = None if pars is None else [par[j:j + batch_size] for par in pars] + [X['fit_t'][j:j + batch_size].T]
+            dm = DynamicsRecoveryBatch(u=u[j:j + batch_size].T, s=s[j:j + batch_size].T, use_raw=use_raw,
+                                       load_pars=load, weights=weights[j:j + batch_size].T)
+            if max_iter > 1:
+                dm.fit(max_iter, learning_rate, **kwargs)
+            fits.append([dm.alpha, dm.beta, dm.gamma, dm.t_, dm.scaling, dm.t, *dm.get_traces()])
+
+    fits = [np.concatenate([fit[k] for fit in fits]) for k in range(5)] + [np.hstack([fit[5] for fit in fits])] \
+        + [[trace for fit in fits for trace in fit[k]] for k in [6, 7]]
+    return fits, dm
+
+
+def fit_dynamics_backed(directory, start, stop, use_raw=False, pars=None, batch_size=None, max_iter=100,
+                        learning_rate=None, return_pars=False, **kwargs):
+    """Fits the genes start to stop (rows of the memmaps in directory) in a worker process and returns only the fitted
+    parameters, time assignments, loss traces and (if return_pars) parameter traces.
+    """
+    filenames = {key: os.path.join(directory, key + '.npy') for key in ['unspliced', 'spliced', 'Mu', 'Ms', 'fit_t']}
+    X = {key: np.load(filename, mmap_mode='r')[start:stop] for key, filename in filenames.items()
+         if os.path.exists(filename)}
+    fits, _ = fit_dynamics(X, use_raw, pars, batch_size, max_iter, learning_rate, **kwargs)
+    return fits if return_pars else fits[:7] + [None]
+
+
+def get_checkpoint_key(adata, use_raw=False, load_pars=False, **fit_settings):
+    """md5 fingerprint of the cells, the inputs of the fit (counts, moments and loaded parameters) and the fit settings,
+    such that a checkpoint is only resumed by a rerun which would yield the same fits.
+    """
+    from hashlib import md5
+    from zlib import crc32
+    keys = ['unspliced', 'spliced'] + ([] if use_raw else ['Mu', 'Ms']) + (['fit_t'] if load_pars else [])
+    data_key = [get_obs_key(adata)]
+    for key in keys:
+        if key in adata.layers.keys():
+            X, crc = adata.layers[key], crc32((key + str(adata.layers[key].shape)).encode())
+            for array in [X.data, X.indices, X.indptr] if issparse(X) else [X]:
+                crc = crc32(np.ascontiguousarray(array), crc)
+            data_key.append(crc)
+        else:  # lazy moments, which are identified by their own key
+            data_key.append(adata.uns['moments']['key'])
+    if load_pars:
+        pars = read_pars(adata)
+        data_key.append(crc32(np.ascontiguousarray(pars, dtype=np.float64)))
+    fit_settings = sorted(dict(fit_settings, use_raw=use_raw, load_pars=load_pars).items())
+    return md5((str(data_key) + str(fit_settings)).encode()).hexdigest()
+
+
+def write_checkpoint(directory, key, fits, var_names):
+    """Writes fits [(pos, (alpha, beta, gamma, t_, scaling, t, losses, pars))] of var_names[pos] to a new file in the
+    checkpoint directory, tagged with the checkpoint key. Files are written under a temporary name first, such that
+    interrupted writes are ignored.
+    """
+    from uuid import uuid4
+    pos = np.concatenate([pos for pos, _ in fits])
+    vals = [np.concatenate([fit[k] for _, fit in fits]) for k in range(5)]
+    losses = [np.asarray(loss, dtype=float) for _, fit in fits for loss in fit[6]]
+
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, 'fits_' + uuid4().hex)
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez_compressed(f, var_names=np.array(var_names[pos], dtype=str), key=key,
+                            alpha=vals[0], beta=vals[1], gamma=vals[2], t_=vals[3], scaling=vals[4],
+                            t=np.hstack([fit[5] for _, fit in fits]), loss=np.concatenate(losses),
+                            n_loss=[len(loss) for loss in losses])
+    os.replace(filename + '.tmp', filename + '.npz')
+
+
+def read_checkpoint(directory, key):
+    """Fits stored in the checkpoint directory as dict: var name -> (alpha, beta, gamma, t_, scaling, t, loss).
+    Checkpoints written with another key (see `get_checkpoint_key`) are refused.
+    """
+    fits = {}
+    filenames = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+    for filename in [filename for filename in filenames if filename.endswith('.npz')]:
+        with np.load(os.path.join(directory, filename)) as f:
+            if 'key' not in f.files or str(f['key']) != key:
+                raise ValueError('Checkpoint ' + directory + ' was written for different cells, inputs or fit '
+                                 'settings. Remove it or choose another name for `checkpoint`.')
+            losses = np.split(f['loss'], np.cumsum(f['n_loss'])[:-1])
+            vals = [f[key] for key in ['alpha', 'beta', 'gamma', 't_', 'scaling', 't']]
+            for i, name in enumerate(f['var_names']):
+                fits[name] = [val[i] for val in vals[:5]] + [vals[5][:, i], losses[i]]
+    return fits
+
+
 def recover_dynamics(data, var_names='all', max_iter=100, learning_rate=None, add_key='fit', t_max=None, use_raw=False,
-                     load_pars=None, return_model=False, plot_results=False, copy=False, **kwargs):
+                     load_pars=None, return_model=False, plot_results=False, batch_size=None, n_jobs=None,
+                     checkpoint=False, copy=False, **kwargs):
     """Estimates velocities in a gene-specific manner
 
     Arguments
     ---------
     data: :class:`~anndata.AnnData`
         Annotated data matrix.
+    batch_size: `int` or `None` (default: `None`)
+        Fit this many genes at once with `DynamicsRecoveryBatch`, which evaluates each step for the whole batch of
+        genes in one pass over (n_obs x batch_size) arrays instead of fitting one gene after another. This is an
+        approximation of the gene-wise fit (`None`), which may reach different optima for single genes.
+    n_jobs: `int` or `None` (default: `None`)
+        Number of worker processes to fit genes in parallel (in ranges of genes or batches of `batch_size`), which
+        read their genes from memory-mapped inputs written to `settings.cachedir`. Yields the same fit as in a single
+        process. Defaults to `settings.n_jobs`. No model is returned with `return_model` if run in parallel.
+    checkpoint: `bool` or `str` (default: `False`)
+        Whether to write the fits of every 100 genes (or batch) to a checkpoint directory, named `'dynamics_' + add_key`
+        or as given, in `settings.cachedir`. A rerun (e.g. after the job has been interrupted) takes genes already
+        fitted from the checkpoint instead of fitting them again, as long as the cells, the inputs of the fit (counts,
+        moments and loaded parameters) and the fit settings are unchanged; otherwise the checkpoint is refused. The
+        checkpoint is removed once all results are written to `adata`.
 
     Returns
     -------
@@ -287,20 +773,84 @@ def recover_dynamics(data, var_names='all', max_iter=100, learning_rate=None, ad
     idx = np.where(idx)[0]
     var_names = adata.var_names[idx]
 
-    alpha, beta, gamma, t_, scaling = read_pars(adata)
-    L, P, T = [], [], adata.layers['fit_t'] if 'fit_t' in adata.layers.keys() else np.zeros(adata.shape) * np.nan
-
-    for i, gene in enumerate(var_names):
-        dm = DynamicsRecovery(adata, gene, use_raw=use_raw, load_pars=load_pars)
-        if max_iter > 1:
-            dm.fit(max_iter, learning_rate, **kwargs)
+    use_raw = use_raw or ('Ms' not in adata.layers.keys() and 'moments' not in adata.uns.keys())
+    load_pars = bool(load_pars) and 'fit_alpha' in adata.var.keys()
 
-        ix = idx[i]
-        alpha[ix], beta[ix], gamma[ix], t_[ix], scaling[ix] = dm.alpha, dm.beta, dm.gamma, dm.t_, dm.scaling
-        T[:, ix] = dm.t
-        L.append(dm.loss)
-        if plot_results and i < 4:
-            P.append(dm.pars)
+    alpha, beta, gamma, t_, scaling = read_pars(adata)
+    L, P, T = {}, {}, adata.layers['fit_t'] if 'fit_t' in adata.layers.keys() else np.zeros(adata.shape) * np.nan
+    fits_unsaved, dm = [], None
+
+    def store(pos, fits, save=True):  # fits (alpha, beta, gamma, t_, scaling, t, losses, pars) of genes var_names[pos]
+        ix = idx[pos]
+        alpha[ix], beta[ix], gamma[ix], t_[ix], scaling[ix] = fits[:5]
+        T[:, ix] = fits[5]
+        L.update(zip(pos, fits[6]))
+        if plot_results and fits[7] is not None:
+            P.update((i, pars) for i, pars in zip(pos, fits[7]) if i < 4)
+        if checkpoint and save:
+            fits_unsaved.append((pos, fits))
+            if sum(len(pos) for pos, _ in fits_unsaved) >= 100:
+                write_checkpoint(directory, key, fits_unsaved, var_names)
+                fits_unsaved.clear()
+
+    if checkpoint:
+        name = checkpoint if isinstance(checkpoint, str) else 'dynamics_' + add_key
+        directory = os.path.join(settings.cachedir, name)
+        key = get_checkpoint_key(adata, use_raw, load_pars, max_iter=max_iter, learning_rate=learning_rate,
+                                 batch_size=batch_size, **kwargs)
+        fits = read_checkpoint(directory, key)
+        pos = np.array([i for i, gene in enumerate(var_names) if gene in fits], dtype=int)
+        if len(pos) > 0:
+            fits = [fits[gene] for gene in var_names[pos]]
+            store(pos, [np.array(vals) for vals in list(zip(*fits))[:5]] + [np.stack([fit[5] for fit in fits], 1),
+                       [fit[6] for fit in fits], None], save=False)
+            logg.info('    loaded ' + str(len(pos)) + ' fitted genes from checkpoint')
+    pos = np.array([i for i in range(len(idx)) if i not in L], dtype=int)
+
+    n_jobs = min(get_n_jobs(n_jobs), len(pos))
+    if return_model and n_jobs > 1:
+        logg.warn('No model is returned with `return_model=True` when fitting with n_jobs > 1.')
+    layers = {key: adata.layers[key].tocsc() if issparse(adata.layers[key]) else adata.layers[key]
+              for key in ['unspliced', 'spliced']}  # to slice gene columns
+
+    if n_jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import get_context
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        size = batch_size if batch_size is not None else int(np.ceil(len(pos) / n_jobs / 4))
+        ranges = [(i, min(i + size, len(pos))) for i in range(0, len(pos), size)]
+
+        os.makedirs(settings.cachedir, exist_ok=True)
+        tmpdir = mkdtemp(prefix='dynamics_', dir=settings.cachedir)
+        try:
+            write_dynamics_inputs(adata, var_names[pos], use_raw, load_pars, tmpdir, layers)
+            # spawned workers, as forked ones inherit threads started before (e.g. by neighbors) and hang at exit
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=get_context('spawn')) as pool:
+                futures = [pool.submit(fit_dynamics_backed, tmpdir, start, stop, use_raw,
+                                       [par[idx[pos[start:stop]]] for par in [alpha, beta, gamma, t_, scaling]]
+                                       if load_pars else None, batch_size, max_iter, learning_rate,
+                                       plot_results and pos[start] < 4, **kwargs) for start, stop in ranges]
+                for (start, stop), future in zip(ranges, futures):
+                    store(pos[start:stop], future.result())
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
+
+    else:  # chunks of genes, with the inputs of each chunk extracted at once
+        size = max(1, int(settings.max_memory * 1e9 / 10 / (adata.n_obs * 8 * 5)))
+        size = size if batch_size is None else max(1, size // batch_size) * batch_size
+        step = 100 if batch_size is None else batch_size  # genes fitted and stored (checkpointed) at once
+        for i in range(0, len(pos), size):
+            X = read_dynamics_inputs(adata, idx[pos[i:i + size]], use_raw, load_pars, layers)
+            for j in range(0, min(size, len(pos) - i), step):
+                ix = idx[pos[i + j:i + j + step]]
+                pars = [par[ix] for par in [alpha, beta, gamma, t_, scaling]] if load_pars else None
+                X_step = {key: X[key][j:j + step] for key in X.keys()}
+                fits, dm = fit_dynamics(X_step, use_raw, pars, batch_size, max_iter, learning_rate, **kwargs)
+                store(pos[i + j:i + j + step], fits)
+
+    if checkpoint and len(fits_unsaved) > 0:
+        write_checkpoint(directory, key, fits_unsaved, var_names)
 
     m = t_max / T.max(0) if t_max is not None else np.ones(adata.n_vars)
     alpha, beta, gamma, T, t_ = alpha / m, beta / m, gamma / m, T * m, t_ * m
@@ -309,31 +859,35 @@ def recover_dynamics(data, var_names='all', max_iter=100, learning_rate=None, ad
     adata.layers['fit_t'] = T
 
     cur_len = adata.varm['loss'].shape[1] if 'loss' in adata.varm.keys() else 2
-    max_len = max(np.max([len(l) for l in L]), cur_len)
+    max_len = max(np.max([len(l) for l in L.values()]), cur_len)
     loss = np.ones((adata.n_vars, max_len)) * np.nan
 
     if 'loss' in adata.varm.keys():
         loss[:, :cur_len] = adata.varm['loss']
 
-    loss[idx] = np.vstack([np.concatenate([l, np.ones(max_len-len(l)) * np.nan]) for l in L])
+    loss[idx] = np.vstack([np.concatenate([L[i], np.ones(max_len-len(L[i])) * np.nan]) for i in range(len(idx))])
     adata.varm['loss'] = loss
 
+    if checkpoint:  # all fits are written to adata
+        from shutil import rmtree
+        rmtree(directory, ignore_errors=True)
+
     logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
     logg.hint('added \n' 
               '    \'' + add_key + '_pars' + '\', fitted parameters for splicing dynamics (adata.var)')
 
-    if plot_results:  # Plot Parameter Stats
+    if plot_results and len(P) > 0:  # Plot Parameter Stats
         figsize = [12, 5]  # rcParams['figure.figsize']
         fontsize = rcParams['font.size']
-        fig, axes = pl.subplots(nrows=len(var_names[:4]), ncols=6, figsize=figsize)
+        fig, axes = pl.subplots(nrows=len(P), ncols=6, figsize=figsize, squeeze=False)
         pl.subplots_adjust(wspace=0.7, hspace=0.5)
-        for i, gene in enumerate(var_names[:4]):
+        for k, i in enumerate(sorted(P.keys())):  # genes loaded from a checkpoint have no parameter trace
             P[i] *= np.array([1 / m[idx[i]], 1 / m[idx[i]], 1 / m[idx[i]], m[idx[i]], 1])[:, None]
             for j, pij in enumerate(P[i]):
-                axes[i][j].plot(pij)
-            axes[i][len(P[i])].plot(L[i])
-            if i == 0:
+                axes[k][j].plot(pij)
+            axes[k][len(P[i])].plot(L[i])
+            if k == 0:
                 for j, name in enumerate(['alpha', 'beta', 'gamma', 't_', 'scaling', 'loss']):
-                    axes[i][j].set_title(name, fontsize=fontsize)
+                    axes[k][j].set_title(name, fontsize=fontsize)
 
     return dm if return_model else adata if copy else None
@@ -241,8 +241,8 @@ def ds(tau, alpha, beta, gamma, u0=0, s0=0, du0=[0, 0, 0], ds0=[0, 0, 0, 0], dta
 def derivatives(u, s, t, t0_, alpha, beta, gamma, scaling=1, alpha_=0, u0=0, s0=0, weights=None):
     o = np.array(t <= t0_, dtype=int)
 
-    du0 = np.array(du(t0_, alpha, beta, u0))[:, None] * (1 - o)[None, :]
-    ds0 = np.array(ds(t0_, alpha, beta, gamma, u0, s0))[:, None] * (1 - o)[None, :]
+    du0 = np.array(du(t0_, alpha, beta, u0))[:, None] * (1 - o)[None]
+    ds0 = np.array(ds(t0_, alpha, beta, gamma, u0, s0))[:, None] * (1 - o)[None]
 
     tau, alpha, u0, s0 = vectorize(t, t0_, alpha, beta, gamma, alpha_, u0, s0)
     dt = np.array(dtau(u, s, alpha, beta, gamma, u0, s0, du0, ds0))
@@ -261,16 +261,190 @@ def derivatives(u, s, t, t0_, alpha, beta, gamma, scaling=1, alpha_=0, u0=0, s0=
         udiff = np.multiply(udiff, weights)
         sdiff = np.multiply(sdiff, weights)
 
-    dl_a = (du_a * (1 - o)).dot(udiff) + (ds_a * (1 - o)).dot(sdiff)
-    dl_a_ = (du_a * o).dot(udiff) + (ds_a * o).dot(sdiff)
+    dot = np.dot if udiff.ndim == 1 else lambda x, y: (x * y).sum(0)  # sum over cells for each gene (column)
+    dl_a = dot(du_a * (1 - o), udiff) + dot(ds_a * (1 - o), sdiff)
+    dl_a_ = dot(du_a * o, udiff) + dot(ds_a * o, sdiff)
 
-    dl_b = du_b.dot(udiff) + ds_b.dot(sdiff)
-    dl_c = ds_c.dot(sdiff)
+    dl_b = dot(du_b, udiff) + dot(ds_b, sdiff)
+    dl_c = dot(ds_c, sdiff)
 
     dl_tau, dl_t0_ = None, None
     return dl_a, dl_b, dl_c, dl_a_, dl_tau, dl_t0_
 
 
+"""Batched dynamics for (n_obs x n_genes) arrays, with per-gene parameters and per-gene weights (cell masks)"""
+
+
+def sum_masked(x, mask=None):
+    return x.sum(0) if mask is None else np.where(mask, x, 0).sum(0)
+
+
+def max_masked(x, mask=None):
+    return x.max(0) if mask is None else np.where(mask, x, -np.inf).max(0)
+
+
+def masked_percentile(X, mask, perc):
+    """np.percentile(X[mask[:, j], j], perc) for each gene (column) j, with linear interpolation as numpy.
+    """
+    n = mask.sum(0)
+    X_sorted = np.sort(np.where(mask, X, np.inf), axis=0)
+    # interpolate in np.percentile's result dtype (float64 for float32 data on numpy<2, float32 on numpy>=2)
+    dtype = np.percentile(np.zeros(2, dtype=X.dtype), 50).dtype
+    pos = (n - 1).astype(dtype) * np.true_divide(perc, dtype.type(100))
+    lo = np.clip(np.floor(pos).astype(int), 0, None)
+    cols = np.arange(X.shape[1])
+    a, b = X_sorted[lo, cols], X_sorted[np.clip(lo + 1, None, np.clip(n - 1, 0, None)), cols]
+
+    # interpolate as np.percentile's lerp to obtain identical thresholds
+    t = np.asarray(pos - lo, dtype=pos.dtype)
+    diff_b_a = np.subtract(b, a)
+    return np.where(t >= .5, np.subtract(b, diff_b_a * (1 - t)), np.add(a, diff_b_a * t))
+
+
+def find_swichting_time_batch(u, s, tau, o, alpha, beta, gamma, w=None):
+    off, on = o == 0, o == 1
+    if w is not None: off, on = off & w, on & w
+
+    beta_ = beta * inv(gamma - beta)
+    ceta_ = alpha / gamma - beta_ * alpha / beta
+
+    x = - ceta_ * exp(-gamma * tau)
+    y = s - beta_ * u
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exp_t0_ = sum_masked(y * x, off) / sum_masked(x ** 2, off)
+    t0_ = np.where(on.any(0), max_masked(tau, on), max_masked(tau, w))
+    is_valid = off.any(0) & (-1 < exp_t0_) & (exp_t0_ < 0)
+    return np.where(is_valid, -1 / gamma * log(exp_t0_ + 1), t0_)
+
+
+def assign_timepoints_batch(u, s, alpha, beta, gamma, t0_=None, u0_=None, s0_=None, w=None):
+    if t0_ is None:
+        t0_ = tau_inv(u0_, s0_, 0, 0, alpha, beta, gamma)
+    if u0_ is None or s0_ is None:
+        u0_, s0_ = (unspliced(t0_, 0, alpha, beta), spliced(t0_, 0, 0, alpha, beta, gamma))
+
+    tau = tau_inv(u, s, 0, 0, alpha, beta, gamma)
+    tau = np.clip(tau, 0, t0_)
+
+    tau_ = tau_inv(u, s, u0_, s0_, 0, beta, gamma)
+    tau_ = np.clip(tau_, 0, max_masked(tau_, s > 0 if w is None else (s > 0) & w))
+
+    diffx = (unspliced(tau, 0, alpha, beta) - u) ** 2 + (spliced(tau, 0, 0, alpha, beta, gamma) - s) ** 2
+    diffx_ = (unspliced(tau_, u0_, 0, beta) - u) ** 2 + (spliced(tau_, s0_, u0_, 0, beta, gamma) - s) ** 2
+
+    o = np.array(diffx <= diffx_, dtype=int)
+    tau = tau * o + tau_ * (1 - o)
+    t = tau * o + (tau_ + t0_) * (1 - o)
+    return t, tau, o
+
+
+def fit_alpha_batch(u, s, tau, o, beta, gamma, w=None):
+    off, on = o == 0, o == 1
+    if w is not None: off, on = off & w, on & w
+
+    expu, exps = exp(-beta * tau), exp(-gamma * tau)
+    t0_ = max_masked(tau * o, w)
+    expu0_, exps0_ = exp(-beta * t0_), exp(-gamma * t0_)
+
+    # from unspliced dynamics ('on' and 'off' state)
+    c_beta = np.where(on, 1 / beta * (1 - expu), 1 / beta * (1 - expu0_) * expu)
+
+    # from spliced dynamics ('on' and 'off' state)
+    c_gamma = np.where(on, (1 - exps) / gamma + (exps - expu) * inv(gamma - beta),
+                       ((1 - exps0_) / gamma + (exps0_ - expu0_) * inv(gamma - beta)) * exps
+                       - (1 - expu0_) * (exps - expu) * inv(gamma - beta))
+
+    on_off = on | off
+    return sum_masked(c_beta * u + c_gamma * s, on_off) / sum_masked(c_beta ** 2 + c_gamma ** 2, on_off)
+
+
+def fit_scaling_batch(u, t, t_, alpha, beta, w=None):
+    tau, alpha, u0, _ = vectorize(t, t_, alpha, beta)
+    ut = unspliced(tau, u0, alpha, beta)
+    return sum_masked(u * ut, w) / sum_masked(ut ** 2, w)
+
+
+"""Parameter grids, evaluated at once on (n_grid x n_obs) arrays with one row per grid point"""
+
+
+def as_grid(*pars):  # grid parameters (one entry per grid point) as column vectors, scalars are shared
+    return [np.asarray(x)[:, None] if np.ndim(x) > 0 else x for x in pars]
+
+
+def on_cells(x, X):
+    """grid parameter x cast to the dtype in which numpy combines a scalar parameter with the cell array X (e.g. float32
+    for float32 cells on numpy<2), such that grid points are evaluated with the same rounding as single parameters.
+    """
+    return x.astype(np.result_type(X, x.dtype.type(0)), copy=False) if np.ndim(x) > 0 else x
+
+
+def unspliced_grid(tau, u0, alpha, beta):  # unspliced for (n_grid x n_obs) tau, parameter terms as in `unspliced`
+    expu = exp(on_cells(-beta, tau) * tau)
+    return on_cells(u0, tau) * expu + on_cells(alpha / beta, tau) * (1 - expu)
+
+
+def spliced_grid(tau, s0, u0, alpha, beta, gamma):  # spliced for (n_grid x n_obs) tau, parameter terms as in `spliced`
+    c = (alpha - u0 * beta) * inv(gamma - beta)
+    expu, exps = exp(on_cells(-beta, tau) * tau), exp(on_cells(-gamma, tau) * tau)
+    return on_cells(s0, tau) * exps + on_cells(alpha / gamma, tau) * (1 - exps) + on_cells(c, tau) * (exps - expu)
+
+
+def tau_inv_grid(u, s, u0, s0, alpha, beta, gamma):  # tau_inv for a grid, parameter terms as in `tau_inv`
+    beta_ = beta * inv(gamma - beta)
+    ceta_ = alpha / gamma - beta_ * (alpha / beta)
+
+    c0 = s0 - beta_ * u0 - ceta_
+    cs = s - on_cells(beta_, u) * u - on_cells(ceta_, u)
+
+    tau = on_cells(- 1 / gamma, cs) * log(cs / on_cells(c0, cs))
+    return tau
+
+
+def find_swichting_time_grid(u, s, tau, o, alpha, beta, gamma):
+    off, on = o == 0, o == 1
+    n_grid = np.broadcast(alpha, beta, gamma).size
+    if off.sum() > 0:
+        alpha, beta, gamma = as_grid(alpha, beta, gamma)
+        u_, s_, tau_ = u[off], s[off], tau[off]
+
+        beta_ = beta * inv(gamma - beta)
+        ceta_ = alpha / gamma - beta_ * alpha / beta
+
+        x = - on_cells(ceta_, tau_) * exp(on_cells(-gamma, tau_) * tau_)
+        y = s_ - on_cells(beta_, u_) * u_
+
+        exp_t0_ = (y * x).sum(-1, keepdims=True) / (x ** 2).sum(-1, keepdims=True)
+        valid = (-1 < exp_t0_) & (exp_t0_ < 0)
+        t0_ = np.where(valid, -1 / gamma * log(exp_t0_ + 1), np.max(tau[on]) if on.sum() > 0 else np.max(tau))
+    else:
+        t0_ = np.max(tau)
+    return np.broadcast_to(t0_, (n_grid, 1))[:, 0]
+
+
+def assign_timepoints_grid(u, s, alpha, beta, gamma, t0_):
+    alpha, beta, gamma, t0_ = as_grid(alpha, beta, gamma, t0_)
+    u0_, s0_ = unspliced(t0_, 0, alpha, beta), spliced(t0_, 0, 0, alpha, beta, gamma)
+
+    tau = tau_inv_grid(u, s, 0, 0, alpha, beta, gamma)
+    tau = np.clip(tau, 0, on_cells(t0_, tau))
+
+    tau_ = tau_inv_grid(u, s, u0_, s0_, 0, beta, gamma)
+    tau_ = np.clip(tau_, 0, np.max(tau_[:, s > 0], axis=1, keepdims=True))
+
+    x_obs = np.stack([u, s])[:, None]
+    xt = np.stack(np.broadcast_arrays(unspliced_grid(tau, 0, alpha, beta), spliced_grid(tau, 0, 0, alpha, beta, gamma)))
+    xt_ = np.stack([unspliced_grid(tau_, u0_, 0, beta), spliced_grid(tau_, s0_, u0_, 0, beta, gamma)])
+
+    diffx = ((xt - x_obs) ** 2).sum(0)
+    diffx_ = ((xt_ - x_obs) ** 2).sum(0)
+
+    o = 1 - np.argmin([diffx, diffx_], axis=0)
+    tau = tau * o + tau_ * (1 - o)
+    t = tau * o + (tau_ + on_cells(t0_, tau_)) * (1 - o)
+    return t, tau, o
+
+
 """Base Class for Dynamics Recovery"""
 
 
@@ -361,6 +535,43 @@ class BaseDynamics:
         loss = np.sum(udiff ** 2 + sdiff ** 2) / len(udiff)
         return loss
 
+    def get_time_assignment_grid(self, t_=None, alpha=None, beta=None, gamma=None):
+        alpha = self.alpha if alpha is None else alpha
+        beta = self.beta if beta is None else beta
+        gamma = self.gamma if gamma is None else gamma
+        if t_ is None:
+            u, s, tau, o, w = self.u / self.scaling, self.s, self.tau, self.o, self.weights
+            if w is not None: u, s, tau, o = (u[w], s[w], tau[w], o[w])
+            t_ = find_swichting_time_grid(u, s, tau, o, alpha, beta, gamma)
+        t, tau, o = assign_timepoints_grid(self.u / self.scaling, self.s, alpha, beta, gamma, t_)
+        return t_, t, tau, o
+
+    def get_loss_grid(self, t=None, t_=None, alpha=None, beta=None, gamma=None, scaling=None, reassign_time=False):
+        """Losses as in `get_loss` for a grid of parameters, each given as an array with one entry per grid point or as
+        a scalar shared by all, and time assignments t (n_grid x n_obs), all evaluated in one pass over the cells.
+        """
+        alpha = self.alpha if alpha is None else alpha
+        beta = self.beta if beta is None else beta
+        gamma = self.gamma if gamma is None else gamma
+        scaling = self.scaling if scaling is None else scaling
+        t = self.t if t is None else t
+        u, s, tau, o, w = self.u, self.s, self.tau, self.o, self.weights
+        if w is not None: u, s, t, tau, o = u[w], s[w], np.ascontiguousarray(t[..., w]), tau[w], o[w]
+
+        if reassign_time:
+            t_ = find_swichting_time_grid(u / scaling, s, tau, o, alpha, beta, gamma) if t_ is None else t_
+            t, tau, o = assign_timepoints_grid(u / scaling, s, alpha, beta, gamma, t_)
+        else:
+            t_ = self.t_ if t_ is None else t_
+
+        t_, alpha, beta, gamma, scaling = as_grid(t_, alpha, beta, gamma, scaling)
+        tau, alpha, u0, s0 = vectorize(t, t_, alpha, beta, gamma)
+
+        udiff = np.array(unspliced(tau, u0, alpha, beta) * scaling - u)
+        sdiff = np.array(spliced(tau, s0, u0, alpha, beta, gamma) - s)
+        loss = np.sum(udiff ** 2 + sdiff ** 2, axis=-1) / udiff.shape[-1]
+        return loss
+
     def get_likelihood(self):
         u, s, t, t_ = self.u, self.s, self.t, self.t_
         alpha, beta, gamma, scaling = self.alpha, self.beta, self.gamma, self.scaling
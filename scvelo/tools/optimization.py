@@ -1,31 +1,63 @@
 from .utils import sum_obs, prod_sum_obs, make_dense
 from scipy.optimize import minimize
-from scipy.sparse import csr_matrix, issparse
+from scipy.sparse import csc_matrix, issparse
 import numpy as np
 import warnings
 
 
+def get_percentile(X, perc):
+    """Percentiles along axis 0 equivalent to np.percentile(X, perc, axis=0) (linear interpolation),
+    using partition-based selection of the neighboring order statistics instead of sorting.
+    """
+    n_obs = X.shape[0]
+    # interpolate in np.percentile's result dtype (float64 for float32 data on numpy<2, float32 on numpy>=2)
+    dtype = np.percentile(np.zeros(2, dtype=X.dtype), 50).dtype
+    pos = (n_obs - 1) * np.atleast_1d(np.true_divide(perc, dtype.type(100)))
+    lo = np.floor(pos).astype(int)
+
+    # select order statistics lo (by partitioning the remainder) and lo + 1 (as minimum of the remainder) per gene
+    X_part, start = np.array(X.T, order='C'), 0
+    a, b = np.zeros((len(lo), X.shape[1]), dtype=X.dtype), np.zeros((len(lo), X.shape[1]), dtype=X.dtype)
+    for k in np.argsort(lo):
+        if lo[k] >= start: X_part[:, start:].partition(lo[k] - start, axis=1)
+        a[k] = X_part[:, lo[k]]
+        b[k] = X_part[:, lo[k] + 1:].min(1) if lo[k] + 1 < n_obs else a[k]
+        start = lo[k] + 1
+
+    # interpolate as np.percentile's lerp to obtain identical thresholds
+    t = np.asarray(pos - lo, dtype=pos.dtype)[:, None]
+    diff_b_a = np.subtract(b, a)
+    res = np.add(a, diff_b_a * t)
+    res = np.where(t >= .5, np.subtract(b, diff_b_a * (1 - t)), res)
+    return res if np.ndim(perc) > 0 else res[0]
+
+
 def get_weight(x, y, perc):
     if issparse(x): x = x.A
     if issparse(y): y = y.A
     xy_norm = x / np.clip(x.max(0), 1e-3, None) + y / np.clip(y.max(0), 1e-3, None)
     if isinstance(perc, int):
-        weights = xy_norm >= np.percentile(xy_norm, perc, axis=0)
+        weights = xy_norm >= get_percentile(xy_norm, perc)
     else:
-        lb, ub = np.percentile(xy_norm, perc, axis=0)
+        lb, ub = get_percentile(xy_norm, perc)
         weights = (xy_norm <= lb) | (xy_norm >= ub)
     return weights
 
 
-def leastsq_NxN(x, y, fit_offset=False, perc=None):
+def get_weights(x, y, perc, fit_offset=False):
+    """Extreme quantile weights as compact sparse per-gene (CSC) index, as used by leastsq_NxN and leastsq_generalized,
+    such that they can be computed once and shared between the fits.
+    """
+    if not fit_offset and isinstance(perc, (list, tuple)): perc = perc[1]
+    return csc_matrix(get_weight(x, y, perc), dtype=bool)
+
+
+def leastsq_NxN(x, y, fit_offset=False, perc=None, weights=None):
     """Solution to least squares: gamma = cov(X,Y) / var(X)
     """
-    if perc is not None:
-        if not fit_offset and isinstance(perc, (list, tuple)): perc = perc[1]
-        weights = csr_matrix(get_weight(x, y, perc)).astype(bool)
+    if weights is None and perc is not None: weights = get_weights(x, y, perc, fit_offset)
+    if weights is not None:
         x, y = weights.multiply(x).tocsr(), weights.multiply(y).tocsr()
-    else:
-        weights = None
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
@@ -78,12 +110,12 @@ def optimize_NxN(x, y, fit_offset=False, perc=None):
     return offset, gamma
 
 
-def leastsq_generalized(x, y, x2, y2, res_std=None, res2_std=None, fit_offset=False, fit_offset2=False, perc=None):
+def leastsq_generalized(x, y, x2, y2, res_std=None, res2_std=None, fit_offset=False, fit_offset2=False, perc=None,
+                        weights=None):
     """Solution to the 2-dim generalized least squares: gamma = inv(X'QX)X'QY
     """
-    if perc is not None:
-        if not fit_offset and isinstance(perc, (list, tuple)): perc = perc[1]
-        weights = csr_matrix(get_weight(x, y, perc)).astype(bool)
+    if weights is None and perc is not None: weights = get_weights(x, y, perc, fit_offset)
+    if weights is not None:
         x, y = weights.multiply(x).tocsr(), weights.multiply(y).tocsr()
 
     n_obs, n_var = x.shape
@@ -91,28 +123,29 @@ def leastsq_generalized(x, y, x2, y2, res_std=None, res2_std=None, fit_offset=Fa
     gamma = np.ones(n_var, dtype="float32")
 
     if (res_std is None) or (res2_std is None): res_std, res2_std = np.ones(n_var), np.ones(n_var)
-    ones, zeros = np.ones(n_obs), np.zeros(n_obs)
+    x, y, x2, y2 = [A.astype(np.float64) if issparse(A) else np.asarray(A) for A in (x, y, x2, y2)]
 
+    # normal equations A'A b = A'y of all genes at once, with the design A = [[1/std, 0, x/std], [0, 1/std2, x2/std2]]
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        x, y = np.vstack((make_dense(x)/res_std, x2/res2_std)), np.vstack((make_dense(y)/res_std, y2/res2_std))
-
-    if fit_offset and fit_offset2:
-        for i in range(n_var):
-            A = np.c_[np.vstack((np.c_[ones/res_std[i], zeros], np.c_[zeros, ones/res2_std[i]])), x[:, i]]
-            offset[i], offset_ss[i], gamma[i] = np.linalg.pinv(A.T.dot(A)).dot(A.T.dot(y[:, i]))
-    elif fit_offset:
-        for i in range(n_var):
-            A = np.c_[np.hstack((ones/res_std[i], zeros)), x[:, i]]
-            offset[i], gamma[i] = np.linalg.pinv(A.T.dot(A)).dot(A.T.dot(y[:, i]))
-    elif fit_offset2:
-        for i in range(n_var):
-            A = np.c_[np.hstack((zeros, ones/res2_std[i])), x[:, i]]
-            offset_ss[i], gamma[i] = np.linalg.pinv(A.T.dot(A)).dot(A.T.dot(y[:, i]))
-    else:
-        for i in range(n_var):
-            A = np.c_[x[:, i]]
-            gamma[i] = np.linalg.pinv(A.T.dot(A)).dot(A.T.dot(y[:, i]))
+        w, w2 = 1 / np.asarray(res_std, dtype=np.float64) ** 2, 1 / np.asarray(res2_std, dtype=np.float64) ** 2
+        AA = np.zeros((n_var, 3, 3))
+        AA[:, 0, 0], AA[:, 1, 1] = n_obs * w, n_obs * w2
+        AA[:, 0, 2] = AA[:, 2, 0] = sum_obs(x, np.float64) * w
+        AA[:, 1, 2] = AA[:, 2, 1] = sum_obs(x2, np.float64) * w2
+        AA[:, 2, 2] = prod_sum_obs(x, x, np.float64) * w + prod_sum_obs(x2, x2, np.float64) * w2
+        Ay = np.stack([sum_obs(y, np.float64) * w, sum_obs(y2, np.float64) * w2,
+                       prod_sum_obs(x, y, np.float64) * w + prod_sum_obs(x2, y2, np.float64) * w2], 1)
+
+    idx = [0, 1, 2] if fit_offset and fit_offset2 else [0, 2] if fit_offset else [1, 2] if fit_offset2 else [2]
+    AA, Ay = AA[:, idx][:, :, idx], Ay[:, idx]
+    valid = np.isfinite(AA).all((1, 2)) & np.isfinite(Ay).all(1)
+    coef = np.full((n_var, len(idx)), np.nan)
+    coef[valid] = np.einsum('ijk, ik -> ij', np.linalg.pinv(AA[valid]), Ay[valid])
+
+    gamma[:] = coef[:, -1]
+    if fit_offset: offset[:] = coef[:, 0]
+    if fit_offset2: offset_ss[:] = coef[:, -2]
 
     offset[np.isnan(offset)] = 0
     offset_ss[np.isnan(offset_ss)] = 0
@@ -123,37 +156,60 @@ def leastsq_generalized(x, y, x2, y2, res_std=None, res2_std=None, fit_offset=Fa
 
 def maximum_likelihood(Ms, Mu, Mus, Mss, fit_offset=False, fit_offset2=False):
     """Maximizing the log likelihood using weights according to empirical bayes
+
+    The likelihood log std(Mu - gamma Ms) + log std(Mu + 2 Mus - gamma (2 Mss - Ms)) only depends on the (co-)variances
+    of the moments. It is the log of two quadratics in gamma, whose stationary points are the roots of a cubic, which
+    are obtained for all genes at once.
+
+    Offsets do not change the likelihood, which only depends on variances. They are set to the mean residuals
+    mean(Mu - gamma Ms) and mean(Mu + 2 Mus - gamma (2 Mss - Ms)), as for least squares with offset. Previously, the
+    numerical optimization left them at their initial value 1e-4, such that `velocity_offset` of `mode='bayes'` changed.
     """
+    Ms, Mu, Mus, Mss = [np.asarray(make_dense(A), dtype=np.float64) for A in (Ms, Mu, Mus, Mss)]
+    if Ms.ndim == 1: Ms, Mu, Mus, Mss = Ms[:, None], Mu[:, None], Mus[:, None], Mss[:, None]
     n_obs, n_var = Ms.shape
     offset, offset_ss = np.zeros(n_var, dtype="float32"), np.zeros(n_var, dtype="float32")
-    gamma = np.ones(n_var, dtype="float32")
 
-    def sse(A, data, b):
-        sigma = (A.dot(data) - b).std(1)
-        return np.log(sigma).sum()  # np.log(np.sqrt(2*np.pi) * sigma).sum() + (.5 * (res/sigma[:, None])**2).sum()
-
-    if fit_offset and fit_offset2:
-        for i in range(n_var):
-            data = np.vstack((Mu[:, i], Ms[:, i], Mus[:, i], Mss[:, i]))
-            offset[i], offset_ss[i], gamma[i] = \
-                minimize(lambda m: sse(np.array([[1, -m[2], 0, 0], [1, m[2], 2, -2 * m[2]]]),
-                                       data, b=np.array(m[0], m[1])), x0=(1e-4, 1e-4, 1), method="L-BFGS-B").x
-    elif fit_offset:
-        for i in range(n_var):
-            data = np.vstack((Mu[:, i], Ms[:, i], Mus[:, i], Mss[:, i]))
-            offset[i], gamma[i] = \
-                minimize(lambda m: sse(np.array([[1, -m[1], 0, 0], [1, m[1], 2, -2 * m[1]]]),
-                                       data, b=np.array(m[0], 0)), x0=(1e-4, 1), method="L-BFGS-B").x
-    elif fit_offset2:
-        for i in range(n_var):
-            data = np.vstack((Mu[:, i], Ms[:, i], Mus[:, i], Mss[:, i]))
-            offset_ss[i], gamma[i] = \
-                minimize(lambda m: sse(np.array([[1, -m[1], 0, 0], [1, m[1], 2, -2 * m[1]]]),
-                                       data, b=np.array(0, m[0])), x0=(1e-4, 1), method="L-BFGS-B").x
-    else:
-        for i in range(n_var):
-            data = np.vstack((Mu[:, i], Ms[:, i], Mus[:, i], Mss[:, i]))
-            gamma[i] = \
-                minimize(lambda m: sse(np.array([[1, -m, 0, 0], [1, m, 2, -2 * m]]), data, b=0),
-                         x0=gamma[i], method="L-BFGS-B").x
+    def cov(A, B):
+        return prod_sum_obs(A, B) / n_obs - sum_obs(A) / n_obs * sum_obs(B) / n_obs
+
+    # var(Mu - gamma Ms) = a1 + b1 gamma + c1 gamma^2, var(P + gamma Q) = a2 + b2 gamma + c2 gamma^2
+    P, Q = Mu + 2 * Mus, Ms - 2 * Mss
+    a1, b1, c1 = cov(Mu, Mu), -2 * cov(Mu, Ms), cov(Ms, Ms)
+    a2, b2, c2 = cov(P, P), 2 * cov(P, Q), cov(Q, Q)
+    a1, c1, a2, c2 = [np.clip(a, 0, None) for a in (a1, c1, a2, c2)]
+
+    def loss(gamma):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return .5 * np.log(a1[:, None] + b1[:, None] * gamma + c1[:, None] * gamma ** 2) \
+                + .5 * np.log(a2[:, None] + b2[:, None] * gamma + c2[:, None] * gamma ** 2)
+
+    # stationary points: q1' q2 + q2' q1 = 0
+    coefs = np.stack([4 * c1 * c2, 3 * (b1 * c2 + b2 * c1), 2 * (b1 * b2 + a1 * c2 + a2 * c1), a1 * b2 + a2 * b1], 1)
+    is_cubic = np.abs(coefs[:, 0]) > 1e-12 * np.abs(coefs).max(1)
+    companion = np.zeros((n_var, 3, 3))
+    companion[:, 1, 0] = companion[:, 2, 1] = 1
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        companion[:, :, 2] = - coefs[:, :0:-1] / coefs[:, :1]
+    is_cubic &= np.isfinite(companion).all((1, 2))
+    roots = np.full((n_var, 3), np.nan, dtype=complex)
+    roots[is_cubic] = np.linalg.eigvals(companion[is_cubic])
+    roots = np.where(np.abs(roots.imag) <= 1e-8 * (1 + np.abs(roots.real)), roots.real, np.nan).real
+
+    # global minimum among the stationary points
+    losses = loss(roots)
+    losses[~np.isfinite(losses)] = np.inf
+    gamma = np.where(np.isfinite(losses).any(1), roots[np.arange(n_var), losses.argmin(1)], 1)
+
+    # degenerate genes with constant Ms or Ms - 2 Mss, where only one of the quadratics depends on gamma
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        gamma[~is_cubic] = np.where(c2 > 0, -b2 / (2 * c2), np.where(c1 > 0, -b1 / (2 * c1), 1))[~is_cubic]
+
+    if fit_offset: offset = (sum_obs(Mu) / n_obs - gamma * sum_obs(Ms) / n_obs).astype(np.float32)
+    if fit_offset2: offset_ss = (sum_obs(P) / n_obs + gamma * sum_obs(Q) / n_obs).astype(np.float32)
+    gamma = gamma.astype(np.float32)
+    offset[np.isnan(offset)], offset_ss[np.isnan(offset_ss)], gamma[np.isnan(gamma)] = 0, 0, 0
     return offset, offset_ss, gamma
@@ -1,5 +1,4 @@
-from ..preprocessing.neighbors import get_connectivities
-from .utils import normalize
+from .utils import normalize, get_recurse_neighbors
 
 from scipy.spatial.distance import pdist, squareform
 from scipy.sparse import csr_matrix
@@ -62,8 +61,12 @@ def transition_matrix(adata, vkey='velocity', basis=None, backward=False, self_t
     if backward: T = T.T
     T = normalize(T)
 
-    if n_neighbors is not None:
-        T = T.multiply(get_connectivities(adata, mode='distances', n_neighbors=n_neighbors, recurse_neighbors=True))
+    if n_neighbors is not None:  # restrict to neighbors and their neighbors, the latter weighted by .5 per path
+        if n_neighbors >= adata.uns['neighbors']['params']['n_neighbors']: n_neighbors = None
+        neighs = get_recurse_neighbors(adata, 1, n_neighbors, self_loops=True)
+        neighs = neighs + get_recurse_neighbors(adata, 2, n_neighbors, self_loops=True) * .5
+        neighs.data = np.clip(neighs.data, 0, 1)
+        T = T.multiply(normalize(neighs).tocsr().astype(np.float32))
 
     if perc is not None:
         threshold = np.percentile(T.data, perc)
@@ -1,7 +1,10 @@
+from .. import settings
+
 from scipy.sparse import csr_matrix, issparse
 import pandas as pd
 import numpy as np
 import warnings
+import os
 
 
 def mean(x, axis=0):
@@ -15,16 +18,16 @@ def make_dense(X):
     return XA
 
 
-def sum_obs(A):
+def sum_obs(A, dtype=None):
     """summation over axis 0 (obs) equivalent to np.sum(A, 0)
     """
-    return A.sum(0).A1 if issparse(A) else np.einsum('ij -> j', A)
+    return A.sum(0, dtype=dtype).A1 if issparse(A) else np.einsum('ij -> j', A, dtype=dtype)
 
 
-def prod_sum_obs(A, B):
+def prod_sum_obs(A, B, dtype=None):
     """dot product and sum over axis 0 (obs) equivalent to np.sum(A * B, 0)
     """
-    return A.multiply(B).sum(0).A1 if issparse(A) else np.einsum('ij, ij -> j', A, B)
+    return A.multiply(B).sum(0, dtype=dtype).A1 if issparse(A) else np.einsum('ij, ij -> j', A, B, dtype=dtype)
 
 
 def prod_sum_var(A, B):
@@ -62,6 +65,50 @@ def cosine_correlation(dX, Vi):
     return result
 
 
+def is_memmap(X):
+    """whether X is memory-mapped (e.g. a np.memmap or h5py dataset) instead of being loaded in memory
+    """
+    from mmap import mmap
+    if type(X).__module__.startswith('h5py'): return True
+    while X is not None:
+        if isinstance(X, (np.memmap, mmap)): return True
+        X = getattr(X, 'base', None)
+    return False
+
+
+def get_rows(X, rows, var_idx=None):
+    """dense rows of X (sparse, memory-mapped or dense), optionally sliced to the columns var_idx
+    """
+    X_rows = X[rows]
+    X_rows = X_rows.A if issparse(X_rows) else np.asarray(X_rows)
+    return np.array(X_rows if var_idx is None else X_rows[:, var_idx], dtype=np.float32)
+
+
+def cosine_correlation_block(X, V, obs_idx, neighs_idx, sqrt_transform=False, var_idx=None):
+    """cosine correlations between V[obs_idx] and X[neighs_idx] - X[obs_idx] for a padded (n_obs x n_neighs) index
+    """
+    if issparse(X) or var_idx is not None:  # read and densify only the rows of the block
+        rows, inv = np.unique(np.concatenate([obs_idx, neighs_idx.ravel()]), return_inverse=True)
+        X_rows = get_rows(X, rows, var_idx)
+        dX = X_rows[inv[len(obs_idx):].reshape(neighs_idx.shape)] - X_rows[inv[:len(obs_idx)], None]
+    else:
+        dX = X[neighs_idx] - X[obs_idx, None]
+    if sqrt_transform: dX = np.sqrt(np.abs(dX)) * np.sign(dX)
+    dX -= dX.mean(-1)[:, :, None]
+    if issparse(V) or var_idx is not None:
+        Vi = get_rows(V, obs_idx, var_idx)
+        if sqrt_transform: Vi = np.sqrt(np.abs(Vi)) * np.sign(Vi)
+        Vi -= Vi.mean(1)[:, None]
+    else:
+        Vi = V[obs_idx]
+    Vi_norm = norm(Vi)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        result = np.einsum('ijk, ik -> ij', dX, Vi) / (np.sqrt(np.einsum('ijk, ijk -> ij', dX, dX)) * Vi_norm[:, None])
+    result[Vi_norm == 0] = 0
+    return result
+
+
 def normalize(X):
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
@@ -78,20 +125,16 @@ def scale(X, min=0, max=1):
     return X
 
 
-def get_indices(dist, n_neighbors=None):
-    D = dist.copy()
-    n_counts = (D > 0).sum(1).A1 if issparse(D) else (D > 0).sum(1)
-    n_neighbors = n_counts.min() if n_neighbors is None else min(n_counts.min(), n_neighbors)
-    rows = np.where(n_counts > n_neighbors)[0]
-    cumsum_neighs = np.insert(n_counts.cumsum(), 0, 0)
-    dat = D.data
-
-    for row in rows:
-        n0, n1 = cumsum_neighs[row], cumsum_neighs[row + 1]
-        rm_idx = n0 + dat[n0:n1].argsort()[n_neighbors:]
-        dat[rm_idx] = 0
-    D.eliminate_zeros()
-    indices = D.indices.reshape((-1, n_neighbors))
+def get_indices(dist, n_neighbors=None, indices=None):
+    """kNN indices as (n_obs x n_neighbors) array, with the distances trimmed to n_neighbors per cell. If the kNN
+    indices of `pp.neighbors` (umap layout, each cell being its own first neighbor) are given, they are used
+    directly without trimming and the distances are returned as they are.
+    """
+    if indices is not None and indices.shape[0] == dist.shape[0] and (n_neighbors or 0) < indices.shape[1]:
+        return np.asarray(indices[:, 1:] if n_neighbors is None else indices[:, 1:n_neighbors + 1]), dist
+    from ..preprocessing.neighbors import select_distances
+    D = select_distances(dist, n_neighbors)
+    indices = D.indices.reshape((-1, D.indptr[1]))
     return indices, D
 
 
@@ -105,6 +148,95 @@ def get_iterative_indices(indices, index, n_recurse_neighbors=2, max_neighs=None
     return indices
 
 
+def get_n_jobs(n_jobs=None):
+    n_jobs = settings.n_jobs if n_jobs is None else n_jobs
+    return os.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+
+
+def get_iterative_neighbors(indices, n_recurse_neighbors=2, counts=False):
+    """recursive neighbors of all cells as sparse CSR pattern, equivalent to get_iterative_indices for each cell, or
+    with the number of paths to each neighbor if counts is set
+    """
+    n_obs, n_neighbors = indices.shape
+    knn = csr_matrix((np.ones(indices.size, dtype=np.float32), indices.ravel(),
+                      np.arange(0, indices.size + 1, n_neighbors)), shape=(n_obs, n_obs))
+    neighs = knn
+    for _ in range(n_recurse_neighbors - 1):
+        neighs = neighs.dot(knn)
+    neighs.sort_indices()
+    if not counts: neighs.data = np.ones(neighs.nnz, dtype=bool)
+    return neighs
+
+
+def get_recurse_neighbors(adata, n_recurse_neighbors=2, n_neighbors=None, self_loops=False):
+    """recursive neighbors built once from adata.uns['neighbors'] and cached in adata.uns['neighbors'], restricted to
+    n_neighbors per cell if given. With self_loops, each cell is its own neighbor and the number of paths is returned.
+    """
+    key = str(n_recurse_neighbors) if n_neighbors is None and not self_loops \
+        else '_'.join([str(n_recurse_neighbors), str(n_neighbors), 'self' if self_loops else ''])
+    cache = adata.uns['neighbors'].get('iterative_indices', {})
+    if key not in cache or cache[key].shape[0] != adata.n_obs:
+        neighbors = adata.uns['neighbors']
+        # restricted neighbors are selected from the distances as by `get_connectivities`, with the same ties
+        indices = get_indices(dist=neighbors['distances'], n_neighbors=n_neighbors,
+                              indices=neighbors.get('indices') if n_neighbors is None else None)[0]
+        if self_loops: indices = np.hstack([np.arange(indices.shape[0])[:, None], indices])
+        cache[key] = get_iterative_neighbors(indices, n_recurse_neighbors, counts=self_loops)
+        adata.uns['neighbors']['iterative_indices'] = cache
+    return cache[key]
+
+
+def select_random_neighbors(neighs, max_neighs):
+    """random selection of max_neighs neighbors for each cell having more than max_neighs neighbors
+    """
+    n_counts = np.diff(neighs.indptr)
+    if n_counts.max() <= max_neighs: return neighs
+    indices = np.split(neighs.indices, neighs.indptr[1:-1])
+    for i in np.where(n_counts > max_neighs)[0]:
+        indices[i] = np.random.choice(indices[i], max_neighs, replace=False)
+    indptr = np.insert(np.minimum(n_counts, max_neighs).cumsum(), 0, 0)
+    return csr_matrix((np.ones(indptr[-1], dtype=bool), np.concatenate(indices), indptr), shape=neighs.shape)
+
+
+def get_timepoint_neighbors(t, n_neighs, random_state=0):
+    """for each cell at timepoint t, a random selection of at most n_neighs cells at timepoint t + 1 as CSR pattern
+
+    Cells are indexed once per timepoint and all selections are drawn at once (Floyd's sampling without replacement).
+    """
+    t = np.asarray(t, dtype=np.float64)
+    n_obs, n_neighs = len(t), np.broadcast_to(n_neighs, t.shape)
+    valid = np.isfinite(t)
+    tpoints, t_idx = np.unique(t[valid], return_inverse=True)
+    order = np.where(valid)[0][np.argsort(t_idx, kind='stable')]  # cells sorted by timepoint
+    starts = np.insert(np.bincount(t_idx, minlength=len(tpoints)).cumsum(), 0, 0)
+
+    # timepoint index of t + 1 for each cell, if any
+    next_idx = np.full(n_obs, -1)
+    pos = np.searchsorted(tpoints, t[valid] + 1)
+    pos_valid = (pos < len(tpoints)) & (tpoints[np.minimum(pos, len(tpoints) - 1)] == t[valid] + 1) & (t[valid] >= 0)
+    next_idx[np.where(valid)[0][pos_valid]] = pos[pos_valid]
+
+    obs_idx = np.where(next_idx >= 0)[0]
+    n_pool = (starts[1:] - starts[:-1])[next_idx[obs_idx]]
+    n_draws = np.minimum(n_neighs[obs_idx], n_pool)
+
+    rng = np.random.RandomState(random_state)
+    draws = np.zeros((len(obs_idx), n_draws.max() if len(obs_idx) > 0 else 0), dtype=np.int64)
+    for r in range(draws.shape[1]):
+        active = r < n_draws
+        j = n_pool - n_draws + r
+        rank = (rng.random_sample(len(obs_idx)) * (j + 1)).astype(np.int64)
+        is_drawn = (draws[:, :r] == rank[:, None]).any(1)
+        draws[active, r] = np.where(is_drawn, j, rank)[active]
+
+    mask = np.arange(draws.shape[1])[None, :] < n_draws[:, None]
+    indices = order[(starts[next_idx[obs_idx]][:, None] + draws)[mask]]
+    rows = np.repeat(obs_idx, n_draws)
+    neighs = csr_matrix((np.ones(len(indices), dtype=bool), (rows, indices)), shape=(n_obs, n_obs))
+    neighs.sort_indices()
+    return neighs
+
+
 def groups_to_bool(adata, groups, groupby=None):
     groups = [groups] if isinstance(groups, str) else groups
     if isinstance(groups, (list, tuple, np.ndarray, np.record)):
@@ -215,8 +347,9 @@ def merge_groups(adata, key, map_groups, key_added=None, map_colors=None):
 
 
 def cutoff_small_velocities(adata, vkey='velocity', key_added='velocity_cut', frac_of_max=.5, use_raw=False):
-    x = adata.layers['spliced'] if use_raw else adata.layers['Ms']
-    y = adata.layers['unspliced'] if use_raw else adata.layers['Mu']
+    from ..preprocessing.moments import get_moments
+    x = adata.layers['spliced'] if use_raw else get_moments(adata, 'Ms')
+    y = adata.layers['unspliced'] if use_raw else get_moments(adata, 'Mu')
 
     x_max = x.max(0).A[0] if issparse(x) else x.max(0)
     y_max = y.max(0).A[0] if issparse(y) else y.max(0)
@@ -1,8 +1,8 @@
 from .. import settings
 from .. import logging as logg
-from ..preprocessing.moments import moments, second_order_moments
-from .optimization import leastsq_NxN, leastsq_generalized, maximum_likelihood
-from .utils import R_squared, groups_to_bool, make_dense, strings_to_categoricals
+from ..preprocessing.moments import moments, second_order_moments, get_moments
+from .optimization import leastsq_NxN, leastsq_generalized, maximum_likelihood, get_weights
+from .utils import R_squared, groups_to_bool, make_dense, strings_to_categoricals, get_n_jobs
 
 import numpy as np
 import warnings
@@ -10,10 +10,12 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
 class Velocity:
-    def __init__(self, adata=None, Ms=None, Mu=None, groups_for_fit=None, groupby=None, residual=None, use_raw=False,):
-        self._adata = adata
-        self._Ms = adata.layers['spliced'] if use_raw else adata.layers['Ms'] if Ms is None else Ms
-        self._Mu = adata.layers['unspliced'] if use_raw else adata.layers['Mu'] if Mu is None else Mu
+    def __init__(self, adata=None, Ms=None, Mu=None, groups_for_fit=None, groupby=None, residual=None, use_raw=False,
+                 obs_idx=None):
+        self._adata, self._obs_idx = adata, obs_idx
+        self._Ms = adata.layers['spliced'] if use_raw else get_moments(adata, 'Ms') if Ms is None else Ms
+        self._Mu = adata.layers['unspliced'] if use_raw else get_moments(adata, 'Mu') if Mu is None else Mu
+        if obs_idx is not None: self._Ms, self._Mu = self._Ms[obs_idx], self._Mu[obs_idx]
         self._Ms, self._Mu = make_dense(self._Ms), make_dense(self._Mu)
 
         n_obs, n_vars = self._Ms.shape
@@ -22,12 +24,19 @@ class Velocity:
         self._gamma, self._r2 = np.zeros(n_vars, dtype=np.float32), np.zeros(n_vars, dtype=np.float32)
         self._beta, self._velocity_genes = np.ones(n_vars, dtype=np.float32), np.ones(n_vars, dtype=bool)
         self._groups_for_fit = groups_to_bool(adata, groups_for_fit, groupby)
+        if obs_idx is not None and self._groups_for_fit is not None:
+            self._groups_for_fit = self._groups_for_fit[obs_idx]
+        self._weights = None
 
     def compute_deterministic(self, fit_offset=False, perc=None):
         Ms = self._Ms if self._groups_for_fit is None else self._Ms[self._groups_for_fit]
         Mu = self._Mu if self._groups_for_fit is None else self._Mu[self._groups_for_fit]
 
-        self._offset, self._gamma = leastsq_NxN(Ms, Mu, fit_offset, perc)
+        # extreme quantile weights are shared with the stochastic fit, if it is done on the same cells
+        weights = get_weights(Ms, Mu, perc, fit_offset) if perc is not None else None
+        if self._groups_for_fit is None: self._weights = weights
+
+        self._offset, self._gamma = leastsq_NxN(Ms, Mu, fit_offset, perc, weights)
         self._residual = self._Mu - self._gamma * self._Ms
         if fit_offset: self._residual -= self._offset
 
@@ -37,14 +46,17 @@ class Velocity:
     def compute_stochastic(self, fit_offset=False, fit_offset2=False, mode=None, perc=None):
         if self._residual is None: self.compute_deterministic(fit_offset=fit_offset, perc=perc)
         idx = self._velocity_genes
+        if not np.any(idx):  # no velocity genes (e.g. in a chunk of genes), keep the deterministic fit
+            self._residual2 = np.zeros(self._Ms.shape, dtype=np.float32)
+            return
         is_subset = True if len(set(idx)) > 1 else False
 
-        _adata = self._adata[:, idx] if is_subset else self._adata
         _Ms = self._Ms[:, idx] if is_subset else self._Ms
         _Mu = self._Mu[:, idx] if is_subset else self._Mu
         _residual = self._residual[:, idx] if is_subset else self._residual
+        _weights = self._weights[:, idx] if is_subset and self._weights is not None else self._weights
 
-        _Mss, _Mus = second_order_moments(_adata)
+        _Mss, _Mus = second_order_moments(self._adata, obs_idx=self._obs_idx, var_idx=idx if is_subset else None)
 
         var_ss = 2 * _Mss - _Ms
         cov_us = 2 * _Mus + _Mu
@@ -58,7 +70,8 @@ class Velocity:
         # solve multiple regression
         self._offset[idx], self._offset2[idx], self._gamma[idx] = \
             maximum_likelihood(_Ms, _Mu, _Mus, _Mss, fit_offset, fit_offset2) if mode == 'bayes' \
-                else leastsq_generalized(_Ms, _Mu, var_ss, cov_us, res_std, res2_std, fit_offset, fit_offset2, perc)
+                else leastsq_generalized(_Ms, _Mu, var_ss, cov_us, res_std, res2_std, fit_offset, fit_offset2, perc,
+                                         _weights)
 
         self._residual = self._Mu - self._gamma * self._Ms
         if fit_offset: self._residual -= self._offset
@@ -85,13 +98,23 @@ class Velocity:
         return ['_offset', '_offset2', '_beta', '_gamma', '_r2', '_genes']
 
 
-def write_residuals(adata, vkey, residual=None, cell_subset=None):
+def write_residuals(adata, vkey, residual=None, cell_subset=None, var_subset=None):
     if residual is not None:
-        if cell_subset is None:
+        if cell_subset is None and var_subset is None:
             adata.layers[vkey] = residual
         else:
             if vkey not in adata.layers.keys(): adata.layers[vkey] = np.zeros(adata.shape, dtype=np.float32)
-            adata.layers[vkey][cell_subset] = residual
+            if var_subset is None:
+                adata.layers[vkey][cell_subset] = residual
+            else:
+                cell_subset = np.arange(adata.n_obs) if cell_subset is None else cell_subset
+                adata.layers[vkey][np.ix_(cell_subset, var_subset)] = residual
+
+
+def get_chunk_size(n_obs, chunk_size=None):
+    """Number of genes per chunk, such that the ~20 (n_obs x chunk_size) arrays of a chunk fit into max_memory.
+    """
+    return max(1, int(settings.max_memory * 1e9 / (n_obs * 4 * 20))) if chunk_size is None else chunk_size
 
 
 def write_pars(adata, vkey, pars, pars_names, add_key=None):
@@ -101,7 +124,8 @@ def write_pars(adata, vkey, pars, pars_names, add_key=None):
 
 
 def velocity(data, vkey='velocity', mode=None, fit_offset=False, fit_offset2=False, filter_genes=False,
-             groups=None, groupby=None, groups_for_fit=None, use_raw=False, perc=[5, 95], copy=False):
+             groups=None, groupby=None, groups_for_fit=None, use_raw=False, perc=[5, 95], chunked=False,
+             chunk_size=None, n_jobs=None, copy=False):
     """Estimates velocities in a gene-specific manner
 
     Arguments
@@ -112,9 +136,10 @@ def velocity(data, vkey='velocity', mode=None, fit_offset=False, fit_offset2=Fal
         Name under which to refer to the computed velocities for `velocity_graph` and `velocity_embedding`.
     mode: `'deterministic'`, `'stochastic'` or `'bayes'` (default: `'stochastic'`)
         Whether to run the estimation using the deterministic or stochastic model of transcriptional dynamics.
-        `'bayes'` solves the stochastic model and accounts for heteroscedasticity, but is slower than `'stochastic'`.
+        `'bayes'` solves the stochastic model and accounts for heteroscedasticity.
     fit_offset: `bool` (default: `False`)
-        Whether to fit with offset for first order moment dynamics.
+        Whether to fit with offset for first order moment dynamics. With `'bayes'`, the offsets do not enter the
+        likelihood and are set to the mean residuals.
     fit_offset2: `bool`, (default: `False`)
         Whether to fit with offset for second order moment dynamics.
     filter_genes: `bool` (default: `True`)
@@ -129,6 +154,15 @@ def velocity(data, vkey='velocity', mode=None, fit_offset=False, fit_offset2=Fal
         Whether to use raw data for estimation.
     perc: `float` (default: `None`)
         Percentile, e.g. 98, upon for extreme quantile fit (to better capture steady states for velocity estimation).
+    chunked: `bool` (default: `False`)
+        Whether to process chunks of genes one after another, with the fits and residuals of each chunk written into
+        preallocated float32 layers. Results are identical to the unchunked fit, while memory is bounded by
+        `settings.max_memory`.
+    chunk_size: `int` or `None` (default: `None`)
+        Number of genes per chunk if `chunked=True`. Derived from `settings.max_memory` if not specified.
+    n_jobs: `int` or `None` (default: `None`)
+        Number of groups to be fitted in parallel if `groupby` is given. Defaults to `settings.n_jobs`. With
+        `filter_genes`, groups are fitted one after another, each on the genes retained by the preceding groups.
     copy: `bool` (default: `False`)
         Return a copy instead of writing to `adata`.
 
@@ -143,7 +177,7 @@ def velocity(data, vkey='velocity', mode=None, fit_offset=False, fit_offset2=Fal
         parameters
     """
     adata = data.copy() if copy else data
-    if not use_raw and 'Ms' not in adata.layers.keys(): moments(adata)
+    if not use_raw and 'Ms' not in adata.layers.keys() and 'moments' not in adata.uns.keys(): moments(adata)
 
     logg.info('computing velocities', r=True)
 
@@ -151,16 +185,27 @@ def velocity(data, vkey='velocity', mode=None, fit_offset=False, fit_offset2=Fal
     categories = adata.obs[groupby].cat.categories \
         if groupby is not None and groups is None and groups_for_fit is None else [None]
 
+    is_stochastic = any([mode is not None and mode in item for item in ['stochastic', 'bayes', 'alpha']])
+    if len(categories) > 1 and not chunked and not filter_genes:
+        velocity_grouped(adata, vkey, categories, groupby, is_stochastic, mode, fit_offset, fit_offset2, use_raw, perc,
+                         n_jobs)
+        categories = []
+
     for cat in categories:
         groups = cat if cat is not None else groups
 
         cell_subset = groups_to_bool(adata, groups, groupby)
         _adata = adata if groups is None else adata[cell_subset]
 
+        if chunked:
+            velocity_chunked(adata, _adata, cell_subset, vkey, is_stochastic, mode, fit_offset, fit_offset2,
+                             groups_for_fit, groupby, use_raw, perc, chunk_size, filter_genes, add_key=cat)
+            continue
+
         velo = Velocity(_adata, groups_for_fit=groups_for_fit, groupby=groupby, use_raw=use_raw)
         velo.compute_deterministic(fit_offset, perc=perc)
 
-        if any([mode is not None and mode in item for item in ['stochastic', 'bayes', 'alpha']]):
+        if is_stochastic:
             if filter_genes and len(set(velo._velocity_genes)) > 1:
                 adata._inplace_subset_var(velo._velocity_genes)
                 residual = velo._residual[:, velo._velocity_genes]
@@ -182,6 +227,73 @@ def velocity(data, vkey='velocity', mode=None, fit_offset=False, fit_offset2=Fal
     return adata if copy else None
 
 
+def velocity_chunked(adata, _adata, cell_subset, vkey, is_stochastic, mode, fit_offset, fit_offset2, groups_for_fit,
+                     groupby, use_raw, perc, chunk_size=None, filter_genes=False, add_key=None):
+    """Velocity estimation for chunks of genes, written into preallocated float32 layers of adata
+    """
+    keys = [vkey, 'variance_' + vkey] if is_stochastic else [vkey]
+    for key in keys:
+        if cell_subset is None or key not in adata.layers.keys():
+            adata.layers[key] = np.zeros(adata.shape, dtype=np.float32)
+
+    n_vars, chunk_size = adata.n_vars, get_chunk_size(_adata.n_obs, chunk_size)
+    pars, pars_names = None, None
+    for start in range(0, n_vars, chunk_size):
+        var_subset = np.arange(start, min(start + chunk_size, n_vars))
+
+        # a slice keeps the layers row-major as in the unchunked fit, so reductions over cells sum in the same order
+        velo = Velocity(_adata[:, start:start + len(var_subset)], groups_for_fit=groups_for_fit, groupby=groupby,
+                        use_raw=use_raw)
+        velo.compute_deterministic(fit_offset, perc=perc)
+        if is_stochastic: velo.compute_stochastic(fit_offset, fit_offset2, mode, perc=perc)
+
+        write_residuals(adata, vkey, velo._residual, cell_subset, var_subset)
+        write_residuals(adata, 'variance_' + vkey, velo._residual2, cell_subset, var_subset)
+
+        if pars is None:
+            pars_names = velo.get_pars_names()
+            pars = [np.zeros(n_vars, dtype=par.dtype) for par in velo.get_pars()]
+        for par, par_chunk in zip(pars, velo.get_pars()):
+            par[var_subset] = par_chunk
+        del velo
+
+    write_pars(adata, vkey, pars, pars_names, add_key=add_key)
+    if filter_genes and len(set(pars[-1])) > 1:
+        adata._inplace_subset_var(pars[-1])
+
+
+def velocity_grouped(adata, vkey, categories, groupby, is_stochastic, mode, fit_offset, fit_offset2, use_raw, perc,
+                     n_jobs=None):
+    """Velocity estimation for each category of groupby, fitted in parallel from row indices (without views)
+    and written into one preallocated layer. Yields the same fits as fitting one category after another.
+
+    Not used with `filter_genes`, where each category is fitted on the genes retained by the preceding categories.
+    """
+    keys = [vkey, 'variance_' + vkey] if is_stochastic else [vkey]
+    for key in keys:
+        if key not in adata.layers.keys(): adata.layers[key] = np.zeros(adata.shape, dtype=np.float32)
+
+    def fit(obs_idx):
+        velo = Velocity(adata, use_raw=use_raw, obs_idx=obs_idx)
+        velo.compute_deterministic(fit_offset, perc=perc)
+        if is_stochastic: velo.compute_stochastic(fit_offset, fit_offset2, mode, perc=perc)
+        adata.layers[vkey][obs_idx] = velo._residual
+        if velo._residual2 is not None: adata.layers['variance_' + vkey][obs_idx] = velo._residual2
+        return velo.get_pars(), velo.get_pars_names()
+
+    obs_idx = [np.where(groups_to_bool(adata, cat, groupby))[0] for cat in categories]
+    n_jobs = min(get_n_jobs(n_jobs), len(categories))
+    if n_jobs > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            pars = list(pool.map(fit, obs_idx))
+    else:
+        pars = [fit(idx) for idx in obs_idx]
+
+    for cat, (cat_pars, pars_names) in zip(categories, pars):
+        write_pars(adata, vkey, cat_pars, pars_names, add_key=cat)
+
+
 def velocity_genes(data, vkey='velocity', min_r2=0.01, highly_variable=None, copy=False):
     """Estimates velocities in a gene-specific manner
 
@@ -1,7 +1,7 @@
 from .. import logging as logg
-from ..preprocessing.moments import moments
+from ..preprocessing.moments import moments, get_moments
 from ..preprocessing.neighbors import neighbors
-from .utils import prod_sum_var, norm, get_indices
+from .utils import prod_sum_var, norm, get_recurse_neighbors
 from .transition_matrix import transition_matrix
 
 import numpy as np
@@ -33,15 +33,15 @@ def velocity_confidence(data, vkey='velocity', copy=False):
             'You need to run `tl.velocity` first.')
 
     idx = np.array(adata.var.velocity_genes.values, dtype=bool)
-    X, V = adata.layers['Ms'][:, idx].copy(), adata.layers[vkey][:, idx].copy()
-    indices = get_indices(dist=adata.uns['neighbors']['distances'])[0]
+    X, V = get_moments(adata, 'Ms', idx).copy(), adata.layers[vkey][:, idx].copy()
+    neighs = get_recurse_neighbors(adata, n_recurse_neighbors=1)
 
     V -= V.mean(1)[:, None]
     V_norm = norm(V)
     R = np.zeros(adata.n_obs)
 
     for i in range(adata.n_obs):
-        Vi_neighs = V[indices[i]]
+        Vi_neighs = V[neighs.indices[neighs.indptr[i]:neighs.indptr[i + 1]]]
         Vi_neighs -= Vi_neighs.mean(1)[:, None]
         R[i] = np.mean(np.einsum('ij, j', Vi_neighs, V[i]) / (norm(Vi_neighs) * V_norm[i])[None, :])
 
@@ -83,7 +83,8 @@ def velocity_confidence_transition(data, vkey='velocity', scale=10, copy=False):
 
     idx = np.array(adata.var.velocity_genes.values, dtype=bool)
     T = transition_matrix(adata, vkey=vkey, scale=scale)
-    dX = T.dot(adata.layers['Ms'][:, idx]) - adata.layers['Ms'][:, idx]
+    X = get_moments(adata, 'Ms', idx)
+    dX = T.dot(X) - X
     dX -= dX.mean(1)[:, None]
 
     V = adata.layers[vkey][:, idx].copy()
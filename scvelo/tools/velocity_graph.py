@@ -1,11 +1,17 @@
 from .. import settings
 from .. import logging as logg
 from ..preprocessing.neighbors import pca, neighbors
-from .utils import cosine_correlation, get_indices, get_iterative_indices
+from ..preprocessing.moments import get_moments
+from .utils import cosine_correlation, cosine_correlation_block, get_indices, get_iterative_neighbors, \
+    get_recurse_neighbors, select_random_neighbors, get_n_jobs, groups_to_bool, is_memmap, \
+    get_timepoint_neighbors
 from .velocity import velocity
 
-from scipy.sparse import coo_matrix, csr_matrix, issparse
+from scipy.sparse import coo_matrix, csr_matrix, diags, issparse
+from numpy.lib.format import open_memmap
 import numpy as np
+import hashlib
+import os
 
 
 def vals_to_csr(vals, rows, cols, shape, split_negative=False):
@@ -26,34 +32,132 @@ def vals_to_csr(vals, rows, cols, shape, split_negative=False):
         return graph.tocsr()
 
 
+def split_negative(data, indices, indptr, shape):
+    """Splits CSR arrays into the positive and negative graph in one pass, without intermediate COO copies.
+    """
+    graphs = []
+    for is_kept, clip in [(data > 0, (0, 1)), (data < 0, (-1, 0))]:
+        n_kept = np.insert(np.cumsum(is_kept, dtype=indptr.dtype), 0, 0)
+        graphs.append(csr_matrix((np.clip(data[is_kept], *clip), indices[is_kept], n_kept[indptr]), shape=shape))
+    return graphs
+
+
+def split_negative_backed(data, indices, indptr, shape, filename, chunk_size=int(1e7)):
+    """Splits memory-mapped CSR arrays chunkwise into the positive and negative graph, which are written to
+    filename + '_*.npy' and filename + '_neg_*.npy' and loaded lazily.
+    """
+    n_obs = len(indptr) - 1
+    n_rows = max(1, int(chunk_size / max(1, np.diff(indptr).max())))
+    chunks = [(r0, min(r0 + n_rows, n_obs)) for r0 in range(0, n_obs, n_rows)]
+    clips = [(0, 1), (-1, 0)]
+
+    n_kept = np.zeros((2, n_obs), dtype=np.int64)
+    for r0, r1 in chunks:
+        vals = np.asarray(data[indptr[r0]:indptr[r1]])
+        for k, is_kept in enumerate([vals > 0, vals < 0]):
+            n_kept[k, r0:r1] = np.diff(np.insert(np.cumsum(is_kept), 0, 0)[indptr[r0:r1 + 1] - indptr[r0]])
+
+    graphs = []
+    for k, key in enumerate(['', '_neg']):
+        indptr_k = np.insert(n_kept[k].cumsum(), 0, 0).astype(indptr.dtype)
+        nnz = int(indptr_k[-1])
+        data_k = open_memmap(filename + key + '_data.npy', mode='w+', dtype=np.float32, shape=(nnz,))
+        indices_k = open_memmap(filename + key + '_indices.npy', mode='w+', dtype=indices.dtype, shape=(nnz,))
+        for r0, r1 in chunks:
+            vals = np.asarray(data[indptr[r0]:indptr[r1]])
+            is_kept = vals > 0 if k == 0 else vals < 0
+            data_k[indptr_k[r0]:indptr_k[r1]] = np.clip(vals[is_kept], *clips[k])
+            indices_k[indptr_k[r0]:indptr_k[r1]] = indices[indptr[r0]:indptr[r1]][is_kept]
+        data_k.flush(), indices_k.flush()
+        np.save(filename + key + '_indptr.npy', indptr_k)
+        del data_k, indices_k
+        graphs.append(load_csr(filename + key, shape=shape))
+    return graphs
+
+
+def load_csr(filename, shape=None, mmap_mode='r'):
+    """Loads a CSR matrix stored as filename + '_data.npy', '_indices.npy' and '_indptr.npy' lazily (memory-mapped).
+    """
+    data, indices, indptr = [np.load(filename + '_' + key + '.npy', mmap_mode=mmap_mode)
+                             for key in ['data', 'indices', 'indptr']]
+    shape = (len(indptr) - 1, len(indptr) - 1) if shape is None else shape
+    return csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+def get_pca(adata, X, subset, key='Ms', n_comps=30, svd_solver='arpack'):
+    """PCA of X (the velocity genes of layer key), cached in adata.uns['pca_velocity_graph'] and
+    adata.varm['PCs_velocity_graph'] and only recomputed if the gene subset, the data or the parameters changed.
+    """
+    X = np.ascontiguousarray(X)
+    md5 = hashlib.md5(X.data)
+    md5.update(np.packbits(subset).tobytes())
+    md5.update(str((key, X.dtype, X.shape, n_comps, svd_solver)).encode())
+    fingerprint = md5.hexdigest()
+
+    cache = adata.uns['pca_velocity_graph'] if 'pca_velocity_graph' in adata.uns.keys() else {}
+    if cache.get('fingerprint') == fingerprint and 'PCs_velocity_graph' in adata.varm.keys():
+        return cache['X_pca'], adata.varm['PCs_velocity_graph'][subset].T
+
+    X_pca, PCs, _, _ = pca(X, n_comps=n_comps, svd_solver=svd_solver, return_info=True)
+    PCs_all = np.zeros((adata.n_vars, PCs.shape[0]), dtype=PCs.dtype)
+    PCs_all[subset] = PCs.T
+    adata.uns['pca_velocity_graph'] = {'fingerprint': fingerprint, 'X_pca': X_pca}
+    adata.varm['PCs_velocity_graph'] = PCs_all
+    return X_pca, PCs
+
+
+def patch_rows(graph, graph_rows, obs_idx):
+    """Replaces the rows obs_idx of graph by those of graph_rows, extending graph by cells appended since.
+    """
+    if graph.shape != graph_rows.shape:
+        graph = csr_matrix(graph, copy=True)
+        graph.resize(graph_rows.shape)
+    keep = np.ones(graph.shape[0], dtype=np.float32)
+    keep[obs_idx] = 0
+    graph = csr_matrix(diags(keep).dot(graph) + graph_rows)
+    graph.eliminate_zeros()
+    return graph
+
+
 class VelocityGraph:
     def __init__(self, adata, vkey='velocity', xkey='Ms', tkey=None, basis=None, n_neighbors=None, sqrt_transform=False,
-                 n_recurse_neighbors=None, random_neighbors_at_max=None, approx=False, report=False):
+                 n_recurse_neighbors=None, random_neighbors_at_max=None, approx=False, svd_solver='arpack',
+                 random_state=0, report=False):
 
         subset = np.array(adata.var.velocity_genes.values, dtype=bool) \
             if 'velocity_genes' in adata.var.keys() else np.ones(adata.n_vars, bool)
-        X = adata.layers[xkey].A[:, subset] if issparse(adata.layers[xkey]) else adata.layers[xkey][:, subset]
-        V = adata.layers[vkey].A[:, subset] if issparse(adata.layers[vkey]) else adata.layers[vkey][:, subset]
-
-        if approx is True and X.shape[1] > 100:
-            X_pca, PCs, _, _ = pca(X,  n_comps=30, svd_solver='arpack', return_info=True)
+        X, V, self.var_idx = adata.layers[xkey] if xkey in adata.layers.keys() else None, adata.layers[vkey], None
+        if X is None: X, subset_X = get_moments(adata, xkey, subset), slice(None)  # lazy moments of velocity genes
+        else: subset_X = subset
+
+        if approx is True and subset.sum() > 100:
+            X = csr_matrix(X)[:, subset_X].A if issparse(X) else X[:, subset_X]
+            V = csr_matrix(V)[:, subset].A if issparse(V) else V[:, subset]
+            X_pca, PCs = get_pca(adata, X, subset, key=xkey, n_comps=30, svd_solver=svd_solver)
             self.X = np.array(X_pca, dtype=np.float32)
             self.V = (V - V.mean(0)).dot(PCs.T)
             self.V[V.sum(1) == 0] = 0
-        else:
-            self.X = np.array(X, dtype=np.float32)
-            self.V = np.array(V, dtype=np.float32)
-
+        elif (is_memmap(X) or is_memmap(V)) and subset_X is subset:  # out-of-core: rows are sliced blockwise
+            self.X, self.V, self.var_idx = X, V, subset
+        else:  # slice velocity genes first, sparse layers (e.g. velocity_cut) are kept sparse
+            X = csr_matrix(X)[:, subset_X] if issparse(X) else X[:, subset_X]
+            V = csr_matrix(V)[:, subset] if issparse(V) else V[:, subset]
+            self.X = csr_matrix(X, dtype=np.float32) if issparse(X) else np.array(X, dtype=np.float32)
+            self.V = csr_matrix(V, dtype=np.float32) if issparse(V) else np.array(V, dtype=np.float32)
+
+        # sparse and out-of-core velocities are transformed and centered blockwise when computing the cosines
         self.sqrt_transform = sqrt_transform
-        if sqrt_transform: self.V = np.sqrt(np.abs(self.V)) * np.sign(self.V)
-        self.V -= self.V.mean(1)[:, None]
+        if not issparse(self.V) and self.var_idx is None:
+            if sqrt_transform: self.V = np.sqrt(np.abs(self.V)) * np.sign(self.V)
+            self.V -= self.V.mean(1)[:, None]
 
         self.n_recurse_neighbors = 1 if n_neighbors is not None \
             else 2 if n_recurse_neighbors is None else n_recurse_neighbors
 
         if 'neighbors' not in adata.uns.keys(): neighbors(adata)
         if n_neighbors is None or n_neighbors < adata.uns['neighbors']['params']['n_neighbors']:
-            self.indices = get_indices(dist=adata.uns['neighbors']['distances'], n_neighbors=n_neighbors)[0]
+            self.indices = get_indices(dist=adata.uns['neighbors']['distances'], n_neighbors=n_neighbors,
+                                       indices=adata.uns['neighbors'].get('indices'))[0]
         else:
             if basis is None: basis = [key for key in ['X_pca', 'X_tsne', 'X_umap'] if key in adata.obsm.keys()][-1]
             elif 'X_' + basis in adata.obsm.keys(): basis = 'X_' + basis
@@ -69,56 +173,136 @@ class VelocityGraph:
                 neighs.compute_neighbors(n_neighbors=n_neighbors, use_rep=basis, n_pcs=10)
                 self.indices = get_indices(dist=neighs.distances)[0]
 
+        self.neighs = get_recurse_neighbors(adata, self.n_recurse_neighbors) if n_neighbors is None \
+            else get_iterative_neighbors(self.indices, self.n_recurse_neighbors)
         self.max_neighs = random_neighbors_at_max
-
-        self.graph = adata.uns[vkey + '_graph'] if vkey + '_graph' in adata.uns.keys() else []
-        self.graph_neg = adata.uns[vkey + '_graph_neg'] if vkey + '_graph_neg' in adata.uns.keys() else []
+        if self.max_neighs is not None: self.neighs = select_random_neighbors(self.neighs, self.max_neighs)
 
         if tkey in adata.obs.keys():
             self.t0 = adata.obs[tkey].copy()
             init = min(self.t0) if isinstance(min(self.t0), int) else 0
-            self.t0.cat.categories = np.arange(init, len(self.t0.cat.categories))
-            self.t1 = self.t0.copy()
-            self.t1.cat.categories = self.t0.cat.categories + 1
+            self.t0 = self.t0.cat.rename_categories(np.arange(init, len(self.t0.cat.categories)))
+            self.t1 = self.t0.cat.rename_categories(self.t0.cat.categories + 1)
+
+            # add cells of the next timepoint, as many as there are neighbors, drawn at once for all cells
+            t_neighs = get_timepoint_neighbors(np.array(self.t0.values, dtype=float), np.diff(self.neighs.indptr),
+                                               random_state=random_state)
+            self.neighs = (self.neighs.astype(np.float32) + t_neighs.astype(np.float32)).astype(bool)
+            self.neighs.sort_indices()
         else: self.t0 = None
 
-        self.report = report
-
-    def compute_cosines(self):
-        vals, rows, cols, n_obs = [], [], [], self.X.shape[0]
-        progress = logg.ProgressReporter(n_obs)
-        for i in range(n_obs):
-            neighs_idx = get_iterative_indices(self.indices, i, self.n_recurse_neighbors, self.max_neighs)
-
-            if self.t0 is not None:
-                t0, t1 = self.t0[i], self.t1[i]
-                if t0 >= 0 and t1 > 0:
-                    t1_idx = np.where(self.t0 == t1)[0]
-                    if len(t1_idx) > len(neighs_idx):
-                        t1_idx = np.random.choice(t1_idx, len(neighs_idx), replace=False)
-                    if len(t1_idx) > 0:
-                        neighs_idx = np.unique(np.concatenate([neighs_idx, t1_idx]))
-
-            if self.V[i].max() != 0 or self.V[i].min() != 0:
-                dX = self.X[neighs_idx] - self.X[i, None]  # 60% of runtime
-                if self.sqrt_transform: dX = np.sqrt(np.abs(dX)) * np.sign(dX)
-                val = cosine_correlation(dX, self.V[i])  # 40% of runtime
-            else:
-                val = np.zeros(len(neighs_idx))
-            vals.extend(val)
-            rows.extend(np.ones(len(neighs_idx)) * i)
-            cols.extend(neighs_idx)
-            if self.report: progress.update()
+        self.graph = adata.uns[vkey + '_graph'] if vkey + '_graph' in adata.uns.keys() else []
+        self.graph_neg = adata.uns[vkey + '_graph_neg'] if vkey + '_graph_neg' in adata.uns.keys() else []
+
+        self.vkey, self.report = vkey, report
+
+    def get_neighbors(self, i):
+        return self.neighs.indices[self.neighs.indptr[i]:self.neighs.indptr[i + 1]]
+
+    def get_block_size(self, n_jobs=1):
+        """Number of cells per block, such that the (block_size x max_neighs x n_vars) arrays of dX of all jobs
+        fit into settings.max_memory.
+        """
+        max_neighs = np.diff(self.neighs.indptr).max()
+        n_vars = self.X.shape[1] if self.var_idx is None else np.sum(self.var_idx)
+        max_bytes = settings.max_memory * 1e9 / n_jobs / 2  # dX and one temporary copy
+        return int(np.clip(max_bytes / (4 * max_neighs * n_vars), 1, 1000))
+
+    def compute_cosines(self, block_size=None, n_jobs=None, obs_idx=None, directory=None):
+        n_obs, n_jobs = self.X.shape[0], get_n_jobs(n_jobs)
+        if block_size is None and (n_jobs > 1 or issparse(self.X) or issparse(self.V) or self.var_idx is not None):
+            block_size = self.get_block_size(n_jobs)
+        obs_idx = np.arange(n_obs) if obs_idx is None else np.sort(obs_idx)
+
+        # preallocate the CSR structure of the graph with the neighbors of each cell as columns
+        n_neighs = np.zeros(n_obs, dtype=np.int64)
+        n_neighs[obs_idx] = np.diff(self.neighs.indptr)[obs_idx]
+        nnz = int(n_neighs.sum())
+        indptr = np.insert(n_neighs.cumsum(), 0, 0).astype(np.int32 if nnz < 2 ** 31 else np.int64)
+        if directory is None:
+            indices = self.neighs[obs_idx].indices.astype(np.int32)
+            data = np.zeros(nnz, dtype=np.float32)
+        else:  # graph rows and their column indices are written incrementally to memory-mapped files
+            os.makedirs(directory, exist_ok=True)
+            filenames = [os.path.join(directory, self.vkey + '_cosines_' + key + '.npy') for key in ['data', 'indices']]
+            data = open_memmap(filenames[0], mode='w+', dtype=np.float32, shape=(nnz,))
+            indices = open_memmap(filenames[1], mode='w+', dtype=np.int32, shape=(nnz,))
+            n_rows = max(1, int(1e7 / max(1, n_neighs.max())))
+            for start in range(0, len(obs_idx), n_rows):
+                rows = obs_idx[start:start + n_rows]
+                indices[indptr[rows[0]]:indptr[rows[-1] + 1]] = self.neighs[rows].indices
+
+        progress = logg.ProgressReporter(len(obs_idx)) if self.report else None
+        if n_jobs > 1:  # shards of consecutive rows, sharing X, V and the graph arrays in memory across threads
+            from concurrent.futures import ThreadPoolExecutor
+            shards = np.array_split(obs_idx, min(n_jobs, len(obs_idx)))
+            with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+                list(pool.map(lambda shard_idx: self.compute_cosines_rows(
+                    shard_idx, data, indices, indptr, block_size, progress), shards))
+        else:
+            self.compute_cosines_rows(obs_idx, data, indices, indptr, block_size, progress)
         if self.report: progress.finish()
 
-        vals = np.hstack(vals)
-        vals[np.isnan(vals)] = 0
+        if directory is None:
+            self.graph, self.graph_neg = split_negative(data, indices, indptr, shape=(n_obs, n_obs))
+        else:
+            data.flush(), indices.flush()
+            self.graph, self.graph_neg = split_negative_backed(
+                data, indices, indptr, shape=(n_obs, n_obs), filename=os.path.join(directory, self.vkey + '_graph'))
+            del data, indices
+            for filename in filenames: os.remove(filename)
+
+    def update_cosines(self, obs_idx, block_size=None, n_jobs=None):
+        """Recomputes the cosines of cells whose velocities or states changed, and of all cells having any of them
+        as neighbor, and patches the existing graph accordingly.
+        """
+        if not issparse(self.graph):
+            raise ValueError('You need to run `tl.velocity_graph` first to compute cosine correlations.')
+        n_obs = self.X.shape[0]
+        changed = np.zeros(n_obs, dtype=np.float32)
+        changed[obs_idx] = 1
+        obs_idx = np.where((changed > 0) | (self.neighs.astype(np.float32).dot(changed) > 0))[0]
+        if len(obs_idx) == 0: return
+
+        graph, graph_neg = self.graph, self.graph_neg
+        self.compute_cosines(block_size=block_size, n_jobs=n_jobs, obs_idx=obs_idx)
+        self.graph = patch_rows(graph, self.graph, obs_idx)
+        self.graph_neg = patch_rows(graph_neg, self.graph_neg, obs_idx)
+
+    def compute_cosines_rows(self, obs_idx, data, indices, indptr, block_size=None, progress=None):
+        """Computes the cosines of the cells obs_idx into the preallocated CSR data, either cell by cell
+        or for blocks of cells at once from a padded (block_size x max_neighs) index matrix.
+        """
+        if block_size is None:
+            for i in obs_idx:
+                n0, n1 = indptr[i], indptr[i + 1]
+                if self.V[i].max() != 0 or self.V[i].min() != 0:
+                    dX = self.X[indices[n0:n1]] - self.X[i, None]  # 60% of runtime
+                    if self.sqrt_transform: dX = np.sqrt(np.abs(dX)) * np.sign(dX)
+                    val = cosine_correlation(dX, self.V[i])  # 40% of runtime
+                    val[np.isnan(val)] = 0
+                    data[n0:n1] = val
+                if progress is not None: progress.update()
+        else:
+            for start in range(0, len(obs_idx), block_size):
+                block_idx = obs_idx[start:start + block_size]
+                n0, n1 = indptr[block_idx[0]], indptr[block_idx[-1] + 1]
+                n_neighs = indptr[block_idx + 1] - indptr[block_idx]
+
+                # pad with the cell itself, which yields dX = 0 and is masked out afterwards
+                mask = np.arange(n_neighs.max())[None, :] < n_neighs[:, None]
+                padded_idx = np.repeat(block_idx[:, None], mask.shape[1], axis=1)
+                padded_idx[mask] = indices[n0:n1]
 
-        self.graph, self.graph_neg = vals_to_csr(vals, rows, cols, shape=(n_obs, n_obs), split_negative=True)
+                val = cosine_correlation_block(self.X, self.V, block_idx, padded_idx, self.sqrt_transform, self.var_idx)
+                val[np.isnan(val)] = 0
+                data[n0:n1] = val[mask]
+                if progress is not None: progress.update(len(block_idx))
 
 
 def velocity_graph(data, vkey='velocity', xkey='Ms', tkey=None, basis=None, n_neighbors=None, n_recurse_neighbors=None,
-                   random_neighbors_at_max=None, sqrt_transform=False, approx=False, copy=False):
+                   random_neighbors_at_max=None, sqrt_transform=False, approx=False, block_size=None, n_jobs=None,
+                   svd_solver='arpack', update_cells=None, backed=False, random_state=0, copy=False):
     """Computes velocity graph based on cosine similarities.
 
     The cosine similarities are computed between velocities and potential cell state transitions.
@@ -138,6 +322,30 @@ def velocity_graph(data, vkey='velocity', xkey='Ms', tkey=None, basis=None, n_ne
         a random selection of such are chosen as reference neighbors.
     sqrt_transform: `bool` (default: `False`)
         Whether to variance-transform the cell states changes and velocities before computing cosine similarities.
+    approx: `bool` (default: `False`)
+        If True, cosine similarities are computed in a 30-dimensional PCA space of the velocity genes. The PCA is
+        cached in `adata.uns['pca_velocity_graph']` and `adata.varm['PCs_velocity_graph']` and reused as long as the
+        gene subset and the data are unchanged.
+    svd_solver: `str` (default: `'arpack'`)
+        SVD solver for the PCA if `approx=True`, e.g. `'randomized'` for faster decomposition on many cells.
+    block_size: `int` or `None` (default: `None`)
+        If specified, cosine similarities are computed for blocks of that many cells at once (vectorized),
+        instead of cell by cell. Results are not bit-identical to the per-cell path, as sums are taken in a
+        different order, but agree to within 1e-6 (float32 rounding).
+        Memory scales with block_size x n_neighbors x n_genes.
+    n_jobs: `int` or `None` (default: `None`)
+        Number of parallel jobs, each computing a shard of consecutive rows. Defaults to `settings.n_jobs`.
+    update_cells: `str`, list of `str`, `np.ndarray` or `None` (default: `None`)
+        Groups (e.g. as passed to `tl.velocity(groups=...)`), boolean mask or indices of cells whose velocities or
+        states changed. Only their rows and the rows of cells neighboring them are recomputed and patched into the
+        existing graph.
+    backed: `bool` or `str` (default: `False`)
+        Whether to write the graph rows incrementally to memory-mapped CSR arrays in the given directory
+        (`settings.cachedir` if `True`), which are loaded lazily. Memory-mapped layers (e.g. `.npy` memmaps) for `xkey`
+        and `vkey` are read blockwise with blocks sized to fit `settings.max_memory`. The recursive neighbor index
+        (one int32 per graph entry) and the row pointers are still held in memory.
+    random_state: `int` (default: 0)
+        Seed for drawing cells of the next timepoint as additional neighbors if `tkey` is given.
     copy: `bool` (default: `False`)
         Return a copy instead of writing to adata.
 
@@ -152,10 +360,16 @@ def velocity_graph(data, vkey='velocity', xkey='Ms', tkey=None, basis=None, n_ne
 
     vgraph = VelocityGraph(adata, vkey=vkey, xkey=xkey, tkey=tkey, basis=basis, n_neighbors=n_neighbors, approx=approx,
                            n_recurse_neighbors=n_recurse_neighbors, random_neighbors_at_max=random_neighbors_at_max,
-                           sqrt_transform=sqrt_transform, report=True)
+                           sqrt_transform=sqrt_transform, svd_solver=svd_solver, random_state=random_state, report=True)
 
     logg.info('computing velocity graph', r=True)
-    vgraph.compute_cosines()
+    if update_cells is not None and vkey + '_graph' in adata.uns.keys():
+        if isinstance(update_cells, str) or isinstance(update_cells[0], str):
+            update_cells = groups_to_bool(adata, update_cells)
+        vgraph.update_cosines(update_cells, block_size=block_size, n_jobs=n_jobs)
+    else:
+        directory = (settings.cachedir if backed is True else backed) if backed else None
+        vgraph.compute_cosines(block_size=block_size, n_jobs=n_jobs, directory=directory)
 
     adata.uns[vkey+'_graph'] = vgraph.graph
     adata.uns[vkey+'_graph_neg'] = vgraph.graph_neg
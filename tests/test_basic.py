@@ -2,6 +2,17 @@ import scvelo as scv
 import numpy as np
 
 
+def simulated_counts(n_obs=300, n_vars=40, seed=0):
+    from anndata import AnnData
+    np.random.seed(seed)
+    alpha = np.random.rand(n_vars) * 5
+    U = np.random.poisson(np.random.rand(n_obs, 1) * alpha).astype(np.float32)
+    S = np.random.poisson(np.random.rand(n_obs, 1) * alpha * 2).astype(np.float32)
+    adata = AnnData(S, layers={'spliced': S, 'unspliced': U})
+    scv.pp.neighbors(adata, n_neighbors=15, method='sklearn')
+    return adata
+
+
 def test_einsum():
     from scvelo.tools.utils import prod_sum_obs, prod_sum_var, norm
     Ms, Mu = np.random.rand(5, 4), np.random.rand(5, 4)
@@ -10,6 +21,312 @@ def test_einsum():
     assert np.allclose(norm(Ms), np.linalg.norm(Ms, axis=1))
 
 
+def test_iterative_neighbors():
+    from scvelo.tools.utils import get_iterative_indices, get_iterative_neighbors
+    indices = np.array([np.random.choice(50, 5, replace=False) for _ in range(50)])
+    neighs = get_iterative_neighbors(indices, n_recurse_neighbors=2)
+    for i in range(50):
+        row = neighs.indices[neighs.indptr[i]:neighs.indptr[i + 1]]
+        assert np.array_equal(row, get_iterative_indices(indices, i, n_recurse_neighbors=2))
+
+
+def test_percentile():
+    from scvelo.tools.optimization import get_percentile
+    X = np.random.rand(100, 4).astype(np.float32)
+    for perc in [5, 98, [5, 95]]:
+        perc_ref = np.percentile(X, perc, axis=0)
+        assert np.array_equal(get_percentile(X, perc), perc_ref) and get_percentile(X, perc).dtype == perc_ref.dtype
+
+
+def test_maximum_likelihood():
+    from scipy.optimize import minimize_scalar
+    from scvelo.tools.optimization import maximum_likelihood
+    adata = simulated_counts()
+    scv.pp.moments(adata, second_order=True)
+    Ms, Mu, Mss, Mus = [adata.layers[key].astype(np.float64) for key in ['Ms', 'Mu', 'Mss', 'Mus']]
+    offset, offset_ss, gamma = maximum_likelihood(Ms, Mu, Mus, Mss, fit_offset=True, fit_offset2=True)
+    for i in range(10):  # numerical minimization of the likelihood, from the best point of a grid
+        loss = lambda g: np.log(np.std(Mu[:, i] - g * Ms[:, i])) \
+            + np.log(np.std(Mu[:, i] + 2 * Mus[:, i] - g * (2 * Mss[:, i] - Ms[:, i])))
+        grid = np.linspace(-10, 10, 20001)
+        g0 = grid[np.argmin([loss(g) for g in grid])]
+        gamma_ref = minimize_scalar(loss, bounds=(g0 - 1e-3, g0 + 1e-3), method='bounded', options={'xatol': 1e-10}).x
+        assert np.isclose(gamma[i], gamma_ref, rtol=1e-5)
+        assert np.isclose(offset[i], np.mean(Mu[:, i] - gamma[i] * Ms[:, i]), rtol=1e-5, atol=1e-6)
+        assert np.isclose(offset_ss[i], np.mean(Mu[:, i] + 2 * Mus[:, i] - gamma[i] * (2 * Mss[:, i] - Ms[:, i])),
+                          rtol=1e-5, atol=1e-6)
+
+
+def test_masked_percentile():
+    from scvelo.tools.dynamical_model_utils import masked_percentile
+    X = np.random.rand(100, 4).astype(np.float32)
+    mask = X > .3
+    for perc in [95, 99]:
+        perc_ref = [np.percentile(X[mask[:, j], j], perc) for j in range(4)]
+        assert np.array_equal(masked_percentile(X, mask, perc), perc_ref)
+        assert masked_percentile(X, mask, perc).dtype == np.asarray(perc_ref).dtype
+
+
+def test_timepoints_grid():
+    from scvelo.tools.dynamical_model_utils import assign_timepoints, assign_timepoints_grid, find_swichting_time, \
+        find_swichting_time_grid
+    u, s, o = np.random.rand(100), np.random.rand(100), np.random.rand(100) > .5
+    alpha, beta, gamma = np.array([2, 3, 4]), 1, np.array([.4, .5, .6])
+    t_ = find_swichting_time_grid(u, s, s, o, alpha, beta, gamma)
+    t = assign_timepoints_grid(u, s, alpha, beta, gamma, t_)[0]
+    for i in range(3):
+        assert t_[i] == find_swichting_time(u, s, s, o, alpha[i], beta, gamma[i])
+        assert np.array_equal(t[i], assign_timepoints(u, s, alpha[i], beta, gamma[i], t_[i])[0])
+
+
+def test_dynamics_grid():
+    from scvelo.tools.dynamical_model import DynamicsRecovery
+
+    class DynamicsRecoverySerial(DynamicsRecovery):  # grid points evaluated one at a time, as before the grids
+        def update_loss_grid(self, t_=None, alpha=None, grid_size=None):
+            improved = False
+            for i in range(len(alpha if t_ is None else t_)):
+                improved = improved or self.update_loss(t_=None if t_ is None else t_[i],
+                                                        alpha=None if alpha is None else alpha[i], reassign_time=True)
+            return improved
+
+        def shuffle_pars(self, alpha_sight=[-.5, .5], gamma_sight=[-.5, .5], num=5, grid_size=None):
+            x = np.linspace(alpha_sight[0], alpha_sight[1], num=num) * self.alpha + self.alpha
+            y = np.linspace(gamma_sight[0], gamma_sight[1], num=num) * self.gamma + self.gamma
+            z = np.array([[self.get_loss(alpha=xi, gamma=yi, reassign_time=True) for yi in y] for xi in x])
+            ix, iy = np.unravel_index(z.argmin(), z.shape)
+            return self.update_loss(alpha=x[ix], gamma=y[ix], reassign_time=True)
+
+    adata = simulated_counts()
+    scv.pp.moments(adata)
+    for j in range(10):  # float32 moments
+        kwargs = dict(u=adata.layers['Mu'][:, j], s=adata.layers['Ms'][:, j], u_raw=adata.layers['unspliced'][:, j],
+                      s_raw=adata.layers['spliced'][:, j])
+        dm, dm_ref = DynamicsRecovery(**kwargs), DynamicsRecoverySerial(**kwargs)
+        dm.fit(max_iter=30), dm_ref.fit(max_iter=30)
+        assert np.array_equal(dm.loss, dm_ref.loss) and np.array_equal(dm.pars, dm_ref.pars)
+
+
+def test_select_neighbors():
+    from scvelo.preprocessing.neighbors import select_distances, select_connectivities
+    from scipy.sparse import random
+    for D in [random(50, 50, density=.3, format='csr'), random(50, 20, density=1, format='csr')]:
+        for data in [D.data, np.ceil(D.data * 3), np.ones(D.nnz)]:  # with ties, as in binary connectivities
+            D.data = data
+            n_neighbors = min(np.diff(D.indptr).min(), 5)
+            for select, sign in [(select_distances, 1), (select_connectivities, -1)]:
+                C = select(D, n_neighbors=n_neighbors)
+                for i in range(50):
+                    row, cols = D.data[D.indptr[i]:D.indptr[i + 1]], D.indices[D.indptr[i]:D.indptr[i + 1]]
+                    order = np.argsort(row, kind='stable')  # first tied entries for distances, last for connectivities
+                    kept = order[:n_neighbors] if sign == 1 else order[::-1][:n_neighbors]
+                    assert np.array_equal(C[i].indices, np.sort(cols[kept]))
+
+
+def test_incremental_neighbors():
+    from anndata import AnnData
+    X = np.random.rand(200, 60).astype(np.float32)
+    adata = AnnData(X[:150])
+    scv.pp.neighbors(adata, n_neighbors=10, method='sklearn', incremental=True)
+    adata_all = AnnData(X)
+    adata_all.uns['neighbors'], adata_all.varm['PCs'] = adata.uns['neighbors'], adata.varm['PCs']
+    scv.pp.neighbors(adata_all, method='sklearn', incremental=True)
+
+    adata_ref = AnnData(X)
+    adata_ref.obsm['X_pca'] = adata_all.obsm['X_pca']
+    scv.pp.neighbors(adata_ref, n_neighbors=10, method='sklearn')
+    C, C_ref = adata_all.uns['neighbors']['connectivities'], adata_ref.uns['neighbors']['connectivities']
+    assert (C != C_ref).nnz == 0
+
+    import pytest
+    adata = AnnData(X[:150])
+    scv.pp.neighbors(adata, n_neighbors=10, method='sklearn', incremental=True)
+    adata_shuffled = AnnData(X[::-1])  # cells of the graph are not the first ones
+    adata_shuffled.uns['neighbors'], adata_shuffled.varm['PCs'] = adata.uns['neighbors'], adata.varm['PCs']
+    adata_shuffled.obs_names = adata_shuffled.obs_names[::-1]
+    with pytest.raises(ValueError, match='do not match'):
+        scv.pp.neighbors(adata_shuffled, method='sklearn', incremental=True)
+
+
+def test_velocity_graph_block():
+    from anndata import AnnData
+    X = np.random.rand(200, 40).astype(np.float32)
+    adata = AnnData(X, layers={'Ms': X, 'velocity': np.random.randn(200, 40).astype(np.float32)})
+    scv.pp.neighbors(adata, n_neighbors=10, method='sklearn')
+    vgraph = scv.VelocityGraph(adata)
+    vgraph.compute_cosines()
+    graph = vgraph.graph - vgraph.graph_neg
+    for block_size in [1, 16, 200]:
+        vgraph.compute_cosines(block_size=block_size)
+        assert np.abs(graph - (vgraph.graph - vgraph.graph_neg)).max() < 1e-6  # float32 rounding, not bit-identical
+
+    from scvelo.tools.utils import get_iterative_indices
+    indices, V = adata.uns['neighbors']['indices'][:, 1:], adata.layers['velocity']
+    graph_ref = np.zeros((200, 200))
+    for i in range(200):  # correlation of the velocity with the state changes to the neighbors of neighbors
+        for j in get_iterative_indices(indices, i, n_recurse_neighbors=2):
+            if j != i: graph_ref[i, j] = np.corrcoef(X[j] - X[i], V[i])[0, 1]
+    assert np.allclose((vgraph.graph + vgraph.graph_neg).A, graph_ref, atol=1e-5)
+
+
+def test_velocity_chunked():
+    adata = simulated_counts()
+    scv.pp.moments(adata)
+    for mode in ['deterministic', 'stochastic']:
+        adata_ref = scv.tl.velocity(adata, mode=mode, copy=True)
+        adata_chunked = scv.tl.velocity(adata, mode=mode, chunked=True, chunk_size=7, copy=True)
+        for key in ['velocity', 'variance_velocity']:
+            if key in adata_ref.layers.keys():
+                assert np.array_equal(adata_ref.layers[key], adata_chunked.layers[key])
+        for key in ['velocity_gamma', 'velocity_r2']:
+            assert np.array_equal(adata_ref.var[key], adata_chunked.var[key])
+
+
+def test_velocity_grouped():
+    adata = simulated_counts()
+    adata.obs['clusters'] = np.array(['a', 'b', 'c'])[np.arange(adata.n_obs) % 3]
+    scv.pp.moments(adata, second_order=True)
+    for mode in ['deterministic', 'stochastic']:
+        scv.tl.velocity(adata, mode=mode, groupby='clusters', n_jobs=2)
+        velocity_grouped = {key: adata.layers[key].copy() for key in ['velocity', 'variance_velocity']
+                            if key in adata.layers.keys()}
+        pars_grouped = adata.var.copy()
+        for cat in ['a', 'b', 'c']:
+            scv.tl.velocity(adata, mode=mode, groupby='clusters', groups=cat)
+            idx = np.array(adata.obs['clusters'] == cat)
+            for key in velocity_grouped.keys():
+                assert np.array_equal(adata.layers[key][idx], velocity_grouped[key][idx])
+            for key in ['velocity_gamma', 'velocity_r2']:
+                assert np.array_equal(adata.var[key], pars_grouped[key + '_' + cat])
+        for key in ['velocity', 'variance_velocity']:
+            if key in adata.layers.keys(): del adata.layers[key]
+
+
+def test_lazy_moments():
+    import pytest
+    from scvelo.preprocessing.moments import get_moments
+    adata, adata_ref = simulated_counts(), simulated_counts()
+    scv.pp.moments(adata, lazy=True)
+    scv.pp.moments(adata_ref)
+    for layer in ['Ms', 'Mu']:
+        assert np.array_equal(get_moments(adata, layer), adata_ref.layers[layer])
+        assert np.array_equal(get_moments(adata[10:50], layer, [1, 3]), adata_ref.layers[layer][10:50, [1, 3]])
+        assert np.array_equal(get_moments(adata[[40, 2, 7], 5:9], layer), adata_ref.layers[layer][[40, 2, 7], 5:9])
+
+    del adata.uns['neighbors']
+    with pytest.raises(ValueError, match='Cells changed'):
+        get_moments(adata[:100].copy(), 'Ms')
+
+
+def test_connectivities_cache():
+    from scvelo.preprocessing.neighbors import get_connectivities
+    adata = simulated_counts()
+    C = get_connectivities(adata)
+    C_ref = adata.uns['neighbors']['connectivities'] > 0
+    C_ref.setdiag(1)
+    assert np.allclose(C.A, C_ref.A / C_ref.A.sum(1, keepdims=True))
+    assert get_connectivities(adata) is C
+    assert adata.uns['neighbors']['params']['version'] == 1
+
+    adata.uns['neighbors']['connectivities'].data[:] = 0  # edited in place, announced by the graph version
+    adata.uns['neighbors']['params']['version'] += 1
+    assert np.array_equal(get_connectivities(adata).A, np.eye(adata.n_obs))
+
+    scv.pp.neighbors(adata, n_neighbors=15, method='sklearn')
+    assert adata.uns['neighbors']['params']['version'] == 3 and np.allclose(get_connectivities(adata).A, C.A)
+
+
+def test_transition_matrix_neighbors():
+    from scvelo.preprocessing.neighbors import get_connectivities
+    adata = simulated_counts()
+    scv.pp.moments(adata, n_neighbors=15)
+    scv.tl.velocity(adata, mode='deterministic')
+    scv.tl.velocity_graph(adata)
+    for n_neighbors in [5, 15]:
+        T = scv.tl.transition_matrix(adata, n_neighbors=n_neighbors)
+        C = get_connectivities(adata, mode='distances', n_neighbors=n_neighbors, recurse_neighbors=True)
+        T_ref = scv.tl.transition_matrix(adata).multiply(C)
+        assert (T != T_ref).nnz == 0
+
+
+def test_second_order_moments():
+    from scvelo.preprocessing.moments import second_order_moments
+    from scvelo.preprocessing.neighbors import get_connectivities
+    adata = simulated_counts()
+    scv.pp.moments(adata, n_neighbors=15, second_order=True)
+    Mss, Mus = second_order_moments(adata)
+    assert np.array_equal(Mss, adata.layers['Mss']) and np.array_equal(Mus, adata.layers['Mus'])
+    s, u, C = adata.layers['spliced'], adata.layers['unspliced'], get_connectivities(adata)
+    assert np.allclose(Mss, C.dot(s * s), rtol=1e-5) and np.allclose(Mus, C.dot(s * u), rtol=1e-5)
+
+    scv.pp.neighbors(adata, n_neighbors=10, method='sklearn')  # cached layers are out of date
+    moments_cached = second_order_moments(adata)
+    del adata.layers['Mss'], adata.layers['Mus']
+    for Mss, Mss_ref in zip(moments_cached, second_order_moments(adata)):
+        assert np.array_equal(Mss, Mss_ref)
+    assert np.allclose(moments_cached[0], get_connectivities(adata).dot(s * s), rtol=1e-5)
+
+
+def test_dynamics_checkpoint(tmpdir):
+    import pytest
+    from scvelo.tools.dynamical_model import get_checkpoint_key, write_checkpoint, read_checkpoint
+    adata = simulated_counts()
+    scv.pp.moments(adata)
+    scv.tl.recover_dynamics(adata, var_names=list(adata.var_names[:2]), max_iter=3)
+    pos, pars = np.arange(2), [adata.var['fit_' + name].values[:2] for name in ['alpha', 'beta', 'gamma', 't_']]
+    fits = pars + [np.ones(2), adata.layers['fit_t'][:, :2], [np.ones(3), np.ones(2)], None]
+
+    key = get_checkpoint_key(adata, max_iter=3)
+    write_checkpoint(str(tmpdir), key, [(pos, fits)], adata.var_names)
+    fits_read = read_checkpoint(str(tmpdir), key)
+    assert list(fits_read.keys()) == list(adata.var_names[:2])
+    for i, name in enumerate(adata.var_names[:2]):
+        assert np.array_equal(fits_read[name][:5], [fit[i] for fit in fits[:5]])
+        assert np.array_equal(fits_read[name][5], fits[5][:, i]) and np.array_equal(fits_read[name][6], fits[6][i])
+
+    for key_changed in [get_checkpoint_key(adata, max_iter=5), get_checkpoint_key(adata, use_raw=True, max_iter=3)]:
+        with pytest.raises(ValueError, match='was written for different'):
+            read_checkpoint(str(tmpdir), key_changed)
+    adata.layers['Ms'][0] += 1  # moments recomputed
+    with pytest.raises(ValueError, match='was written for different'):
+        read_checkpoint(str(tmpdir), get_checkpoint_key(adata, max_iter=3))
+
+
+def test_recover_dynamics_parallel(tmpdir):
+    import subprocess
+    import sys
+    import os
+    # in a fresh process, which needs to exit although neighbors and moments started threads before the pool
+    script = """if True:
+        import os, sys, numpy as np, scvelo as scv
+        sys.path.insert(0, {tests!r})
+        from test_basic import simulated_counts
+        from scvelo.tools.dynamical_model import get_checkpoint_key, write_checkpoint
+        scv.settings.cachedir = {cachedir!r}
+        adata = simulated_counts()
+        scv.pp.moments(adata)
+        var_names, names = list(adata.var_names[:12]), ['alpha', 'beta', 'gamma', 't_', 'scaling']
+        ref = scv.tl.recover_dynamics(adata, var_names, max_iter=10, batch_size=3, n_jobs=1, copy=True)
+
+        # checkpoint of an interrupted run with the first three genes
+        key = get_checkpoint_key(adata, max_iter=10, learning_rate=None, batch_size=3)
+        pos, losses = np.arange(3), [loss[~np.isnan(loss)] for loss in ref.varm['loss'][:3]]
+        fits = [ref.var['fit_' + name].values[:3] for name in names] + [ref.layers['fit_t'][:, :3], losses, None]
+        write_checkpoint(os.path.join({cachedir!r}, 'dynamics_fit'), key, [(pos, fits)], adata.var_names)
+
+        scv.tl.recover_dynamics(adata, var_names, max_iter=10, batch_size=3, n_jobs=2, checkpoint=True)
+        for name in names:
+            assert np.array_equal(adata.var['fit_' + name], ref.var['fit_' + name], equal_nan=True)
+        assert np.array_equal(adata.layers['fit_t'], ref.layers['fit_t'], equal_nan=True)
+        assert np.array_equal(adata.varm['loss'], ref.varm['loss'], equal_nan=True)
+        assert os.listdir({cachedir!r}) == []  # checkpoint and memory-mapped inputs removed
+        print('done')
+    """.format(tests=os.path.dirname(__file__), cachedir=str(tmpdir))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(scv.__file__)))
+    result = subprocess.run([sys.executable, '-c', script], env=env, stdout=subprocess.PIPE, timeout=600)
+    assert result.returncode == 0 and b'done' in result.stdout
+
+
 # def test_velocity_graph():
 #     adata = scv.datasets.toy_data(n_obs=500)
 #     scv.pp.recipe_velocity(adata, n_top_genes=300)